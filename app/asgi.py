@@ -0,0 +1,241 @@
+"""ASGI app serving the upstream-bound endpoints without holding a thread per request
+
+GET /api/panchang and GET /api/locations are handled by coroutines that wait
+on upstream through a shared, pooled async HTTP client, so one process can
+keep thousands of them in flight. Every other request is passed unchanged to
+the Flask WSGI app, which runs on a worker thread.
+
+Serve with an ASGI server, e.g. ``uvicorn asgi:app``.
+"""
+import asyncio
+import io
+import sys
+import threading
+import requests
+from flask import current_app, jsonify, request
+from flask.signals import request_started
+from app import upstream
+from app.locations import search_locations_async
+from app.panchang import get_panchang_data_async
+from app.routes import panchang_args, panchang_response
+
+async def _panchang():
+    location_id, date, error = panchang_args()
+    if error is not None:
+        return error
+
+    return panchang_response(location_id, date, await get_panchang_data_async(location_id, date))
+
+async def _locations():
+    city = request.args.get('city')
+    if not city:
+        return jsonify({'error': 'city parameter is required'}), 400
+
+    try:
+        return jsonify(await search_locations_async(city))
+    except requests.RequestException as e:
+        current_app.logger.error(f"Error fetching location data: {str(e)}")
+        return jsonify({'error': 'Failed to fetch location data'}), 500
+
+ROUTES = {
+    '/api/panchang': _panchang,
+    '/api/locations': _locations,
+}
+
+# Request body chunks read ahead of the WSGI app
+BODY_QUEUE_SIZE = 8
+
+def _environ(scope, body=None):
+    """Build the WSGI environ of an HTTP request from its ASGI scope and body stream"""
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body if body is not None else io.BytesIO(),
+        # The body stream ends with the request, so it can be read to EOF
+        # without a Content-Length (chunked uploads)
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    server = scope.get('server') or ('localhost', 80)
+    environ['SERVER_NAME'], environ['SERVER_PORT'] = server[0], str(server[1])
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f'HTTP_{name}'
+        value = value.decode('latin-1')
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    return environ
+
+class _RequestBody(io.RawIOBase):
+    """Request body read by a WSGI app on a worker thread as the chunks arrive
+
+    ``chunks`` is an asyncio.Queue on ``loop`` that the connection's receive
+    loop fills, ending with None. It is bounded, so an upload is only read
+    off the connection as fast as the app consumes it.
+    """
+
+    def __init__(self, chunks, loop):
+        self._chunks = chunks
+        self._loop = loop
+        self._buffer = b''
+        self._offset = 0
+        self._done = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._offset == len(self._buffer) and not self._done:
+            chunk = asyncio.run_coroutine_threadsafe(self._chunks.get(), self._loop).result()
+            if chunk is None:
+                self._done = True
+            else:
+                self._buffer, self._offset = chunk, 0
+        n = min(len(b), len(self._buffer) - self._offset)
+        b[:n] = self._buffer[self._offset:self._offset + n]
+        self._offset += n
+        return n
+
+async def _receive_body(receive, chunks, disconnected):
+    """Pass request body chunks to ``chunks`` and then wait for the client to disconnect
+
+    This is the connection's only reader, as ASGI allows one ``receive`` at
+    a time.
+    """
+    more_body = True
+    try:
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                disconnected.set()
+                return
+            if message['type'] == 'http.request' and more_body:
+                if message.get('body'):
+                    await chunks.put(message['body'])
+                more_body = message.get('more_body', False)
+                if not more_body:
+                    await chunks.put(None)
+    finally:
+        if more_body:
+            # The body won't be completed; end it for a reader still waiting,
+            # dropping unread chunks nobody is left to answer
+            while not chunks.empty():
+                chunks.get_nowait()
+            chunks.put_nowait(None)
+
+def _start_message(status, headers):
+    return {
+        'type': 'http.response.start',
+        'status': int(status.split(' ', 1)[0]),
+        'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+    }
+
+async def _send_response(send, status, headers, body):
+    await send(_start_message(status, headers))
+    await send({'type': 'http.response.body', 'body': body})
+
+def _run_wsgi(wsgi_app, environ, send, loop, disconnected):
+    """Run a WSGI app on this worker thread, passing its response to ``send`` on ``loop``
+
+    Each chunk is sent as the app yields it, so streamed responses are never
+    held in memory whole. Iteration stops once the client has disconnected.
+    """
+    started = []
+    def start_response(status, headers, exc_info=None):
+        started[:] = [status, headers]
+
+    def call(message):
+        # Waiting for each send gives the app the client's backpressure
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    app_iter = wsgi_app(environ, start_response)
+    try:
+        headers_sent = False
+        for chunk in app_iter:
+            if disconnected.is_set():
+                return
+            if not chunk:
+                continue
+            if not headers_sent:
+                call(_start_message(*started))
+                headers_sent = True
+            call({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        if not headers_sent:
+            call(_start_message(*started))
+        call({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+def create_asgi_app(flask_app):
+    """Wrap ``flask_app`` in an ASGI app that serves ROUTES asynchronously"""
+    async def handle(scope, send):
+        # Same request context, hooks and error handling as the Flask views
+        # get; this mirrors Flask.full_dispatch_request with an awaited view
+        environ = _environ(scope)
+        with flask_app.request_context(environ):
+            try:
+                request_started.send(flask_app, _async_wrapper=flask_app.ensure_sync)
+                try:
+                    rv = flask_app.preprocess_request()
+                    if rv is None:
+                        rv = await ROUTES[scope['path']]()
+                except Exception as e:
+                    rv = flask_app.handle_user_exception(e)
+                response = flask_app.finalize_request(rv)
+            except Exception as e:
+                response = flask_app.handle_exception(e)
+            # Drops the body of HEAD and 304 responses, as the WSGI path does
+            app_iter, status, headers = response.get_wsgi_response(environ)
+            body = b''.join(app_iter)
+        await _send_response(send, status, headers, body)
+
+    async def handle_wsgi(scope, receive, send):
+        # Flask views block, so they run on a worker thread. The body is
+        # streamed to them, so large uploads are never held in memory whole.
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue(BODY_QUEUE_SIZE)
+        environ = _environ(scope, io.BufferedReader(_RequestBody(chunks, loop)))
+        disconnected = threading.Event()
+
+        receiver = asyncio.create_task(_receive_body(receive, chunks, disconnected))
+        try:
+            await asyncio.to_thread(_run_wsgi, flask_app, environ, send, loop, disconnected)
+        finally:
+            receiver.cancel()
+
+    async def lifespan(receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await upstream.close_async_http_client()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def app(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await lifespan(receive, send)
+        if scope['type'] == 'websocket':
+            # There are no websocket routes; refuse the handshake
+            await receive()
+            await send({'type': 'websocket.close', 'code': 1000})
+            return
+        if scope['type'] != 'http':
+            raise RuntimeError(f"Unsupported ASGI scope type: {scope['type']}")
+        if scope['method'] in ('GET', 'HEAD') and scope['path'] in ROUTES:
+            return await handle(scope, send)
+        return await handle_wsgi(scope, receive, send)
+
+    return app
@@ -1,11 +1,53 @@
-from flask import Blueprint, current_app, url_for, redirect, request, flash, jsonify
+from flask import Blueprint, current_app, url_for, redirect, request, flash, jsonify, g
 from flask_login import login_user, logout_user, login_required, current_user
 from functools import wraps
+import threading
 from app.models import User, db
-from app import oauth
 
 auth = Blueprint('auth', __name__)
 
+# OAuth providers, registered with authlib the first time they are used
+OAUTH_PROVIDERS = {
+    'github': {
+        'config_prefix': 'GITHUB',
+        'access_token_url': 'https://github.com/login/oauth/access_token',
+        'access_token_params': None,
+        'authorize_url': 'https://github.com/login/oauth/authorize',
+        'authorize_params': None,
+        'api_base_url': 'https://api.github.com/',
+        'client_kwargs': {'scope': 'user:email'},
+    },
+    'linkedin': {
+        'config_prefix': 'LINKEDIN',
+        'access_token_url': 'https://www.linkedin.com/oauth/v2/accessToken',
+        'authorize_url': 'https://www.linkedin.com/oauth/v2/authorization',
+        'api_base_url': 'https://api.linkedin.com/v2/',
+        'client_kwargs': {'scope': 'r_liteprofile r_emailaddress'},
+    },
+}
+
+_oauth_lock = threading.Lock()
+
+def get_oauth_client(name):
+    """Return the OAuth client for provider ``name``, creating it on first use"""
+    with _oauth_lock:
+        oauth = current_app.extensions.get('authlib.integrations.flask_client')
+        if oauth is None:
+            # authlib is only imported once someone logs in
+            from authlib.integrations.flask_client import OAuth
+            oauth = OAuth(current_app._get_current_object())
+        client = oauth.create_client(name)
+        if client is None:
+            provider = dict(OAUTH_PROVIDERS[name])
+            prefix = provider.pop('config_prefix')
+            client = oauth.register(
+                name=name,
+                client_id=current_app.config[f'{prefix}_CLIENT_ID'],
+                client_secret=current_app.config[f'{prefix}_CLIENT_SECRET'],
+                **provider
+            )
+    return client
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -16,7 +58,9 @@ def token_required(f):
         user = User.verify_api_token(token)
         if not user:
             return jsonify({'error': 'Invalid API token'}), 401
-            
+        
+        # Routes read the authenticated user from here instead of verifying again
+        g.api_user = user
         return f(*args, **kwargs)
     return decorated
 
@@ -29,12 +73,12 @@ def generate_token():
 
 @auth.route('/login/github')
 def github_login():
-    github = oauth.create_client('github')
+    github = get_oauth_client('github')
     return github.authorize_redirect(url_for('auth.login_github_callback', _external=True))
 
 @auth.route('/login/github/callback')
 def login_github_callback():
-    github = oauth.create_client('github')
+    github = get_oauth_client('github')
     token = github.authorize_access_token()
     # Get user profile
     resp = github.get('user', token=token)
@@ -61,12 +105,12 @@ def login_github_callback():
 
 @auth.route('/login/linkedin')
 def linkedin_login():
-    linkedin = oauth.create_client('linkedin')
+    linkedin = get_oauth_client('linkedin')
     return linkedin.authorize_redirect(url_for('auth.login_linkedin_callback', _external=True))
 
 @auth.route('/login/linkedin/callback')
 def login_linkedin_callback():
-    linkedin = oauth.create_client('linkedin')
+    linkedin = get_oauth_client('linkedin')
     token = linkedin.authorize_access_token()
     resp = linkedin.get('me')
     user_info = resp.json()
@@ -0,0 +1,313 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+from app.parser import PARSER_VERSION
+
+class LRUCache:
+    """In-process LRU cache with per-entry TTL"""
+
+    def __init__(self, max_entries=1024, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                # Expired entries stay around for get_stale until evicted
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def get_stale(self, key):
+        """Return the value for ``key`` even if it has expired"""
+        with self._lock:
+            entry = self._data.get(key)
+            return None if entry is None else entry[0]
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            'entries': len(self._data),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+class SQLiteCache:
+    """Durable cache tier backed by a SQLite table
+
+    Values must be JSON serializable. Entries past their TTL are treated as
+    misses (but remain available to ``get_stale``) and the least recently
+    used entries are evicted once the table grows beyond ``max_entries``.
+
+    Reads don't write: access times are kept in memory and written with the
+    next write, or once TOUCH_BATCH reads have piled up. The entry count is
+    tracked as entries are added and only recounted when it passes
+    ``max_entries``; eviction then removes an extra ``max_entries // 100``
+    entries so it runs rarely.
+
+    For panchang data this tier sits in front of the PanchangDay table,
+    which is the record of every fetched day: it keeps the finished result
+    dicts (feed and parsed fields) in a local file shared by the processes
+    on a host, so restarts and worker processes are served without a
+    query to the main database, which may be remote.
+    """
+
+    # Reads whose access times are held in memory before being written
+    TOUCH_BATCH = 256
+
+    def __init__(self, path, max_entries=100000, ttl=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS panchang_cache ('
+            ' key TEXT PRIMARY KEY,'
+            ' value TEXT NOT NULL,'
+            ' created_at REAL NOT NULL,'
+            ' accessed_at REAL NOT NULL)'
+        )
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS ix_panchang_cache_accessed_at '
+            'ON panchang_cache (accessed_at)'
+        )
+        self._conn.commit()
+        # Approximate when other processes share the file; exact after eviction
+        self._size = self._conn.execute('SELECT COUNT(*) FROM panchang_cache').fetchone()[0]
+        self._touched = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value, created_at FROM panchang_cache WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            value, created_at = row
+            if self.ttl and created_at + self.ttl < now:
+                # Expired rows stay around for get_stale until evicted
+                self.misses += 1
+                return None
+            self._touched[key] = now
+            if len(self._touched) >= self.TOUCH_BATCH:
+                self._write_touched()
+                self._conn.commit()
+            self.hits += 1
+        return json.loads(value)
+
+    def _write_touched(self):
+        """Write pending access times; the caller holds the lock and commits"""
+        if self._touched:
+            self._conn.executemany(
+                'UPDATE panchang_cache SET accessed_at = ? WHERE key = ?',
+                [(accessed_at, key) for key, accessed_at in self._touched.items()]
+            )
+            self._touched.clear()
+
+    def _evict(self):
+        """Trim the table below ``max_entries``; the caller holds the lock and commits"""
+        # Other processes sharing the file add entries too, so recount first
+        self._size = self._conn.execute('SELECT COUNT(*) FROM panchang_cache').fetchone()[0]
+        overflow = self._size - self.max_entries
+        if overflow <= 0:
+            return
+        self._write_touched()
+        deleted = self._conn.execute(
+            'DELETE FROM panchang_cache WHERE key IN ('
+            ' SELECT key FROM panchang_cache ORDER BY accessed_at LIMIT ?)',
+            (overflow + self.max_entries // 100,)
+        ).rowcount
+        self._size -= deleted
+        self.evictions += deleted
+
+    def get_stale(self, key):
+        """Return the value for ``key`` even if it has expired"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value FROM panchang_cache WHERE key = ?', (key,)
+            ).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set(self, key, value):
+        now = time.time()
+        payload = json.dumps(value)
+        with self._lock:
+            exists = self._conn.execute(
+                'SELECT 1 FROM panchang_cache WHERE key = ?', (key,)
+            ).fetchone()
+            self._conn.execute(
+                'INSERT OR REPLACE INTO panchang_cache (key, value, created_at, accessed_at) '
+                'VALUES (?, ?, ?, ?)',
+                (key, payload, now, now)
+            )
+            self._touched.pop(key, None)
+            if not exists:
+                self._size += 1
+                if self._size > self.max_entries:
+                    self._evict()
+            # Piggyback pending access times on this write
+            self._write_touched()
+            self._conn.commit()
+
+    def delete(self, key):
+        with self._lock:
+            self._touched.pop(key, None)
+            self._size -= self._conn.execute(
+                'DELETE FROM panchang_cache WHERE key = ?', (key,)
+            ).rowcount
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._touched.clear()
+            self._conn.execute('DELETE FROM panchang_cache')
+            self._size = 0
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM panchang_cache').fetchone()[0]
+
+    def stats(self):
+        return {
+            'entries': len(self),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+class TieredCache:
+    """Looks up each tier in order and back-fills faster tiers on a hit
+
+    Any object providing ``get``, ``get_stale``, ``set``, ``delete``,
+    ``clear`` and ``stats`` can be used as a tier.
+    """
+
+    def __init__(self, *tiers):
+        self.tiers = tiers
+
+    def get(self, key):
+        for i, tier in enumerate(self.tiers):
+            value = tier.get(key)
+            if value is not None:
+                for faster_tier in self.tiers[:i]:
+                    faster_tier.set(key, value)
+                return value
+        return None
+
+    def get_stale(self, key):
+        for tier in self.tiers:
+            value = tier.get_stale(key)
+            if value is not None:
+                return value
+        return None
+
+    def set(self, key, value):
+        for tier in self.tiers:
+            tier.set(key, value)
+
+    def delete(self, key):
+        for tier in self.tiers:
+            tier.delete(key)
+
+    def clear(self):
+        for tier in self.tiers:
+            tier.clear()
+
+    def stats(self):
+        return {type(tier).__name__: tier.stats() for tier in self.tiers}
+
+def make_panchang_cache(app):
+    """Build the panchang cache configured for ``app``"""
+    ttl = app.config['PANCHANG_CACHE_TTL']
+    tiers = [LRUCache(app.config['PANCHANG_CACHE_MEMORY_MAX_ENTRIES'], ttl)]
+
+    if app.config['PANCHANG_CACHE_DURABLE']:
+        path = app.config['PANCHANG_CACHE_PATH']
+        if path is None:
+            # Keep the cache next to the default sqlite:///panchang.db
+            os.makedirs(app.instance_path, exist_ok=True)
+            path = os.path.join(app.instance_path, 'panchang_cache.db')
+        tiers.append(SQLiteCache(path, app.config['PANCHANG_CACHE_DISK_MAX_ENTRIES'], ttl))
+
+    return TieredCache(*tiers)
+
+_init_lock = threading.Lock()
+
+def _get_app_cache(name, factory):
+    """Return ``current_app.extensions[name]``, creating it with ``factory(app)`` on first use"""
+    app = current_app._get_current_object()
+    cache = app.extensions.get(name)
+    if cache is None:
+        with _init_lock:
+            cache = app.extensions.get(name)
+            if cache is None:
+                cache = factory(app)
+                app.extensions[name] = cache
+    return cache
+
+def get_panchang_cache():
+    """Return the panchang cache for the current app, creating it on first use"""
+    return _get_app_cache('panchang_cache', make_panchang_cache)
+
+def get_rendered_email_cache():
+    """Return the cache of rendered per-city email cards for the current app"""
+    return _get_app_cache('rendered_email_cache', lambda app: LRUCache(
+        app.config['RENDERED_EMAIL_CACHE_MAX_ENTRIES'],
+        app.config['PANCHANG_CACHE_TTL']
+    ))
+
+def get_api_token_cache():
+    """Return the cache of verified API tokens for the current app"""
+    return _get_app_cache('api_token_cache', lambda app: LRUCache(
+        app.config['API_TOKEN_CACHE_MAX_ENTRIES'],
+        app.config['API_TOKEN_CACHE_TTL']
+    ))
+
+def panchang_cache_key(location_id, date):
+    """Cache key for a location and a ``YYYY-MM-DD`` date string, as parsed by this parser version"""
+    return f"{location_id}:{date}:v{PARSER_VERSION}"
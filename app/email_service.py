@@ -1,148 +1,30 @@
 from flask import current_app
 from flask_mail import Mail, Message
-from bs4 import BeautifulSoup
-import re
+import smtplib
+from app import metrics
+from app.parser import PARSER_VERSION, PanchangData, parse_panchang
+from app.cache import get_rendered_email_cache
 
 mail = Mail()
 
+def get_mail():
+    """Return the Flask-Mail extension, set up for the current app on first use"""
+    if 'mail' not in current_app.extensions:
+        mail.init_app(current_app._get_current_object())
+    return mail
+
 def parse_panchang_data(raw_data):
     """Parse the raw panchang data into structured format"""
-    soup = BeautifulSoup(raw_data, 'html.parser')
-    text_content = soup.get_text()
-    
-    # Split the text into lines and clean them
-    lines = [line.strip() for line in text_content.split('\n') if line.strip()]
-    
-    data = {
-        'location': lines[0],  # First line is location
-        'date': lines[1],      # Second line is date
-        'shaka': lines[2],     # Shaka details
-        'vikrami_north': lines[3],  # Vikrami North
-        'vikrami_gujarat': lines[4],  # Vikrami Gujarat
-    }
-    
-    # Process the remaining lines
-    for line in lines[5:]:
-        if '🔆' in line:
-            data['sunrise_sunset'] = line.replace('🔆', '').strip()
-        elif '🌙' in line:
-            data['moonrise_moonset'] = line.replace('🌙', '').strip()
-        elif 'Tamil:' in line:
-            data['tamil'] = line
-        elif 'Paksha' in line:
-            data['paksha'] = line
-        elif 'till' in line:
-            # Handle various 'till' cases
-            if 'Rahukalam:' in line:
-                data['rahukalam'] = line
-            elif 'Yamagandam:' in line:
-                data['yamagandam'] = line
-            elif 'Gulikai:' in line:
-                data['gulikai'] = line
-            elif 'Abhijit:' in line:
-                data['abhijit'] = line
-            elif 'Durmuhurtham:' in line:
-                data['durmuhurtham'] = line
-            elif 'Varjyam:' in line:
-                data['varjyam'] = line
-            elif 'Amritkalam:' in line:
-                data['amritkalam'] = line
-            else:
-                # Other 'till' cases (Tithi, Nakshatra, etc.)
-                key = line.split(' till')[0].lower()
-                data[key] = line
-        elif 'Sun:' in line:
-            data['sun'] = line
-        elif 'Moon:' in line:
-            data['moon'] = line
-        elif 'Sayana Sun:' in line:
-            data['sayana_sun'] = line
-        elif 'Sun Star:' in line:
-            data['sun_star'] = line
-        elif 'DikShoolai:' in line:
-            data['dikshoolai'] = line
-        elif 'Kaal Vaasa:' in line:
-            data['kaal_vaasa'] = line
-        elif 'Rahu Vaasa:' in line:
-            data['rahu_vaasa'] = line
-        elif 'Agnivasa:' in line:
-            data['agnivasa'] = line
-        elif 'Moon abode:' in line:
-            if 'moon_abode' not in data:
-                data['moon_abode'] = []
-            data['moon_abode'].append(line)
-        elif 'Shraddha Tithi' in line:
-            data['shraddha_tithi'] = line
-    
-    return data
+    with metrics.parse_seconds.time():
+        return parse_panchang(raw_data)
 
-def create_email_html(city_name, date, panchang_data):
-    """Create HTML email content with a beautiful card design"""
+def create_panchang_card(city_name, date, panchang_data):
+    """Create the HTML card with one city's panchang"""
     html = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <style>
-            .panchang-card {{
-                max-width: 600px;
-                margin: 0 auto;
-                font-family: Arial, sans-serif;
-                background: #ffffff;
-                border-radius: 12px;
-                box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-                overflow: hidden;
-            }}
-            .card-header {{
-                background: #4a90e2;
-                color: white;
-                padding: 20px;
-                text-align: center;
-            }}
-            .card-body {{
-                padding: 20px;
-            }}
-            .greeting {{
-                text-align: center;
-                font-size: 1.2em;
-                color: #333;
-                margin-bottom: 20px;
-                padding: 10px;
-            }}
-            .info-section {{
-                margin: 15px 0;
-                padding: 15px;
-                background: #f8f9fa;
-                border-radius: 8px;
-            }}
-            .info-title {{
-                color: #4a90e2;
-                font-weight: bold;
-                margin-bottom: 10px;
-            }}
-            .info-content {{
-                color: #333;
-                line-height: 1.5;
-            }}
-            .footer {{
-                text-align: center;
-                padding: 20px;
-                color: #666;
-                font-size: 12px;
-            }}
-            .divider {{
-                border-top: 1px solid #eee;
-                margin: 10px 0;
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="greeting">
-            Namaste, here is your daily panchang for {city_name}:
-        </div>
         <div class="panchang-card">
             <div class="card-header">
-                <h2>{panchang_data.get('location', city_name)}</h2>
-                <p>{panchang_data.get('date', date)}</p>
+                <h2>{panchang_data.location or city_name}</h2>
+                <p>{panchang_data.date or date}</p>
             </div>
             <div class="card-body">
     """
@@ -152,10 +34,10 @@ def create_email_html(city_name, date, panchang_data):
     <div class="info-section">
         <div class="info-title">Calendar Systems</div>
         <div class="info-content">
-            {panchang_data.get('shaka', '')}<br>
-            {panchang_data.get('vikrami_north', '')}<br>
-            {panchang_data.get('vikrami_gujarat', '')}<br>
-            {panchang_data.get('tamil', '')}
+            {panchang_data.shaka}<br>
+            {panchang_data.vikrami_north}<br>
+            {panchang_data.vikrami_gujarat}<br>
+            {panchang_data.tamil}
         </div>
     </div>
     """
@@ -165,12 +47,12 @@ def create_email_html(city_name, date, panchang_data):
     <div class="info-section">
         <div class="info-title">☀️ Sun and Moon Timings</div>
         <div class="info-content">
-            Sunrise/Sunset: {panchang_data.get('sunrise_sunset', '')}<br>
-            Moonrise/Moonset: {panchang_data.get('moonrise_moonset', '')}<br>
-            {panchang_data.get('sun', '')}<br>
-            {panchang_data.get('moon', '')}<br>
-            {panchang_data.get('sayana_sun', '')}<br>
-            {panchang_data.get('sun_star', '')}
+            Sunrise/Sunset: {panchang_data.sunrise_sunset}<br>
+            Moonrise/Moonset: {panchang_data.moonrise_moonset}<br>
+            {panchang_data.sun}<br>
+            {panchang_data.moon}<br>
+            {panchang_data.sayana_sun}<br>
+            {panchang_data.sun_star}
         </div>
     </div>
     """
@@ -180,12 +62,11 @@ def create_email_html(city_name, date, panchang_data):
     <div class="info-section">
         <div class="info-title">Panchang Elements</div>
         <div class="info-content">
-            {panchang_data.get('paksha', '')}<br>
-            Tithi: {panchang_data.get('shashti', '')}<br>
-            Nakshatra: {panchang_data.get('chitra', '')}<br>
-            Yoga: {panchang_data.get('ganda', '')}<br>
-            Karana: {panchang_data.get('garaja', '')}<br>
-            {panchang_data.get('vanija', '')}
+            {panchang_data.paksha}<br>
+            Tithi: {'<br>'.join(panchang_data.tithi)}<br>
+            Nakshatra: {'<br>'.join(panchang_data.nakshatra)}<br>
+            Yoga: {'<br>'.join(panchang_data.yoga)}<br>
+            Karana: {'<br>'.join(panchang_data.karana)}
         </div>
     </div>
     """
@@ -195,13 +76,13 @@ def create_email_html(city_name, date, panchang_data):
     <div class="info-section">
         <div class="info-title">⏰ Important Timings</div>
         <div class="info-content">
-            {panchang_data.get('rahukalam', '')}<br>
-            {panchang_data.get('yamagandam', '')}<br>
-            {panchang_data.get('gulikai', '')}<br>
-            {panchang_data.get('abhijit', '')}<br>
-            {panchang_data.get('durmuhurtham', '')}<br>
-            {panchang_data.get('varjyam', '')}<br>
-            {panchang_data.get('amritkalam', '')}
+            {panchang_data.rahukalam}<br>
+            {panchang_data.yamagandam}<br>
+            {panchang_data.gulikai}<br>
+            {panchang_data.abhijit}<br>
+            {panchang_data.durmuhurtham}<br>
+            {panchang_data.varjyam}<br>
+            {panchang_data.amritkalam}
         </div>
     </div>
     """
@@ -211,43 +92,131 @@ def create_email_html(city_name, date, panchang_data):
     <div class="info-section">
         <div class="info-title">🧭 Directional Information</div>
         <div class="info-content">
-            {panchang_data.get('dikshoolai', '')}<br>
-            {panchang_data.get('kaal_vaasa', '')}<br>
-            {panchang_data.get('rahu_vaasa', '')}<br>
-            {panchang_data.get('agnivasa', '')}
+            {panchang_data.dikshoolai}<br>
+            {panchang_data.kaal_vaasa}<br>
+            {panchang_data.rahu_vaasa}<br>
+            {panchang_data.agnivasa}
         </div>
     </div>
     """
     
     # Moon Abode
-    if 'moon_abode' in panchang_data:
+    if panchang_data.moon_abode:
         html += f"""
         <div class="info-section">
             <div class="info-title">🌙 Moon Abode</div>
             <div class="info-content">
-                {'<br>'.join(panchang_data['moon_abode'])}
+                {'<br>'.join(panchang_data.moon_abode)}
             </div>
         </div>
         """
     
     # Shraddha Tithi
-    if 'shraddha_tithi' in panchang_data:
+    if panchang_data.shraddha_tithi:
         html += f"""
         <div class="info-section">
             <div class="info-title">Shraddha Tithi</div>
             <div class="info-content">
-                {panchang_data['shraddha_tithi']}
+                {panchang_data.shraddha_tithi}
             </div>
         </div>
         """
     
-    # Close the HTML
+    # Close the card
     html += """
             </div>
-            <div class="footer">
-                <p>To manage your subscription preferences, please visit our website.</p>
-                <p style="font-size: 10px; color: #888;">Panchang data provided by MyPanchang (<a href="https://mypanchang.com/" style="color: #4a90e2; text-decoration: none;">https://mypanchang.com/</a>). All credits for the data go to MyPanchang.</p>
-            </div>
+        </div>
+    """
+    
+    return html
+
+def _join_names(names):
+    if len(names) == 1:
+        return names[0]
+    return f"{', '.join(names[:-1])} and {names[-1]}"
+
+def create_email_html(cards):
+    """Create HTML email content with a beautiful card design, one card per city
+    
+    Args:
+        cards (list): (city_name, card HTML) pairs, the cards made by
+            create_panchang_card
+    
+    Returns:
+        str: The email body
+    """
+    html = f"""
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <style>
+            .panchang-card {{
+                max-width: 600px;
+                margin: 0 auto 20px;
+                font-family: Arial, sans-serif;
+                background: #ffffff;
+                border-radius: 12px;
+                box-shadow: 0 2px 4px rgba(0,0,0,0.1);
+                overflow: hidden;
+            }}
+            .card-header {{
+                background: #4a90e2;
+                color: white;
+                padding: 20px;
+                text-align: center;
+            }}
+            .card-body {{
+                padding: 20px;
+            }}
+            .greeting {{
+                text-align: center;
+                font-size: 1.2em;
+                color: #333;
+                margin-bottom: 20px;
+                padding: 10px;
+            }}
+            .info-section {{
+                margin: 15px 0;
+                padding: 15px;
+                background: #f8f9fa;
+                border-radius: 8px;
+            }}
+            .info-title {{
+                color: #4a90e2;
+                font-weight: bold;
+                margin-bottom: 10px;
+            }}
+            .info-content {{
+                color: #333;
+                line-height: 1.5;
+            }}
+            .footer {{
+                max-width: 600px;
+                margin: 0 auto;
+                text-align: center;
+                padding: 20px;
+                color: #666;
+                font-size: 12px;
+            }}
+            .divider {{
+                border-top: 1px solid #eee;
+                margin: 10px 0;
+            }}
+        </style>
+    </head>
+    <body>
+        <div class="greeting">
+            Namaste, here is your daily panchang for {_join_names([city_name for city_name, _ in cards])}:
+        </div>
+    """
+    
+    html += ''.join(card for _, card in cards)
+    
+    # Close the HTML
+    html += """
+        <div class="footer">
+            <p>To manage your subscription preferences, please visit our website.</p>
+            <p style="font-size: 10px; color: #888;">Panchang data provided by MyPanchang (<a href="https://mypanchang.com/" style="color: #4a90e2; text-decoration: none;">https://mypanchang.com/</a>). All credits for the data go to MyPanchang.</p>
         </div>
     </body>
     </html>
@@ -255,24 +224,118 @@ def create_email_html(city_name, date, panchang_data):
     
     return html
 
+def render_panchang_card(city_name, panchang_data):
+    """Render a city's card, reusing an earlier rendering if any
+    
+    The card only depends on (location_id, city_name, date) and the parser
+    version, so it is rendered once and shared by every recipient.
+    """
+    cache = get_rendered_email_cache()
+    cache_key = (panchang_data['location_id'], city_name, panchang_data['date'], PARSER_VERSION)
+    card = cache.get(cache_key)
+    if card is None:
+        if 'panchang' in panchang_data:
+            parsed_data = PanchangData(**panchang_data['panchang'])
+        else:
+            # Cached before the parsed fields were kept alongside the feed
+            parsed_data = parse_panchang_data(panchang_data['raw_data'])
+        with metrics.render_seconds.time():
+            card = create_panchang_card(
+                city_name,
+                panchang_data['date'],
+                parsed_data
+            )
+        cache.set(cache_key, card)
+    return card
+
+def build_digest_message(user_email, cities):
+    """Build one panchang email for a user covering several cities
+    
+    Args:
+        user_email (str): Recipient
+        cities (list): (city_name, panchang_data) pairs, one card each
+    """
+    html_content = create_email_html([
+        (city_name, render_panchang_card(city_name, panchang_data))
+        for city_name, panchang_data in cities
+    ])
+    
+    # Message() reads the default sender from the initialized extension
+    get_mail()
+    return Message(
+        subject="PyPanchang: Your Daily Panchang",
+        recipients=[user_email],
+        html=html_content
+    )
+
+def build_panchang_message(user_email, city_name, panchang_data):
+    """Build the panchang email message for a user"""
+    return build_digest_message(user_email, [(city_name, panchang_data)])
+
 def send_panchang_email(user_email, city_name, panchang_data):
     """Send panchang email to a user"""
     try:
-        parsed_data = parse_panchang_data(panchang_data['raw_data'])
-        html_content = create_email_html(
-            city_name,
-            panchang_data['date'],
-            parsed_data
-        )
-        
-        msg = Message(
-            subject="PyPanchang: Your Daily Panchang",
-            recipients=[user_email],
-            html=html_content
-        )
-        
-        mail.send(msg)
+        msg = build_panchang_message(user_email, city_name, panchang_data)
+        with metrics.smtp_send_seconds.time():
+            get_mail().send(msg)
+        metrics.emails_sent_total.inc()
         return True
     except Exception as e:
+        metrics.emails_failed_total.inc()
         current_app.logger.error(f"Error sending email to {user_email}: {str(e)}")
-        return False 
\ No newline at end of file
+        return False
+
+class SMTPSender:
+    """Sends messages over one reused SMTP connection, reconnecting if it drops
+    
+    Not thread-safe; concurrent senders each need their own instance.
+    """
+
+    def __init__(self):
+        self.messages_per_connection = current_app.config['MAIL_MESSAGES_PER_CONNECTION']
+        self.connection = None
+        self.sent_on_connection = 0
+        self.last_error = None  # Why the latest failed message wasn't sent
+
+    def send(self, msg):
+        """Send ``msg``; return True if it was sent"""
+        sent = False
+        for attempt in range(2):
+            try:
+                if self.connection is None:
+                    self.connection = get_mail().connect()
+                    self.connection.__enter__()
+                    self.sent_on_connection = 0
+                with metrics.smtp_send_seconds.time():
+                    self.connection.send(msg)
+                sent = True
+                break
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                    smtplib.SMTPDataError) as e:
+                # The connection is fine, this message was rejected
+                current_app.logger.error(f"Error sending email to {msg.recipients}: {str(e)}")
+                self.last_error = str(e)
+                break
+            except (smtplib.SMTPException, OSError) as e:
+                current_app.logger.warning(
+                    f"SMTP connection failed while sending to {msg.recipients}: {str(e)}"
+                )
+                self.last_error = str(e)
+                self.close()
+        if sent:
+            metrics.emails_sent_total.inc()
+            self.sent_on_connection += 1
+            if self.sent_on_connection >= self.messages_per_connection:
+                self.close()
+        else:
+            metrics.emails_failed_total.inc()
+        return sent
+
+    def close(self):
+        connection, self.connection = self.connection, None
+        if connection is None:
+            return
+        try:
+            connection.__exit__(None, None, None)
+        except (smtplib.SMTPException, OSError):
+            pass
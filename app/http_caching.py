@@ -0,0 +1,78 @@
+"""ETags, conditional requests, Cache-Control and compression for API responses"""
+import gzip
+import hashlib
+from flask import current_app, jsonify, request
+from flask.sessions import SecureCookieSessionInterface
+
+try:
+    import brotli
+except ImportError:
+    # Brotli is optional; without it responses are only gzip-compressed
+    brotli = None
+
+def _negotiate_encoding(size):
+    """Pick the content coding for a body of ``size`` bytes, or None to send it as is"""
+    if size < current_app.config['HTTP_COMPRESSION_MIN_SIZE']:
+        return None
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+def _compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body)
+    return gzip.compress(body, compresslevel=6)
+
+def cached_json_response(data, key, max_age, immutable=False):
+    """
+    jsonify ``data`` as a cacheable, conditionally served and compressed response
+
+    The strong ETag is derived from ``key`` (what the resource is) and a
+    hash of the body. Compressed variants get their own ETag, as their
+    bytes differ. A matching If-None-Match gets a bodiless 304.
+
+    Args:
+        data: JSON-serializable response data
+        key (str): Identifies the resource, e.g. "location_id:date"
+        max_age (int): Seconds clients and shared caches may reuse the response
+        immutable (bool): Whether the response will never change
+
+    Returns:
+        Response: A 200 or 304 response
+    """
+    response = jsonify(data)
+    body = response.get_data()
+    encoding = _negotiate_encoding(len(body))
+
+    digest = hashlib.sha256(key.encode('utf-8') + b'\0' + body).hexdigest()[:32]
+    response.set_etag(f"{digest}-{encoding}" if encoding else digest)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    if immutable:
+        response.cache_control.immutable = True
+    response.vary.add('Accept-Encoding')
+
+    response.make_conditional(request)
+    if response.status_code == 200 and encoding:
+        response.set_data(_compress(body, encoding))
+        response.content_encoding = encoding
+    return response
+
+class PublicResponseSessionInterface(SecureCookieSessionInterface):
+    """Cookie sessions that keep public responses shareable
+
+    Flask adds ``Vary: Cookie`` whenever the session is read, and
+    Flask-Login reads it after every request, so shared caches would store
+    a copy of each public response per visitor. Public responses don't
+    depend on the session, so the header is dropped from them unless the
+    session was changed.
+    """
+
+    def save_session(self, app, session, response):
+        super().save_session(app, session, response)
+        if response.cache_control.public and not session.modified:
+            # Lowercase, as HeaderSet.remove matches header names case-sensitively
+            response.vary.discard('cookie')
@@ -0,0 +1,180 @@
+import json
+import click
+import requests
+from datetime import datetime, timedelta
+from flask import current_app
+from flask.cli import with_appcontext
+from app.models import db, Location, LocationCoverage, LocationQuery, run_in_db_thread
+from app.upstream import fetch_upstream, fetch_upstream_async
+
+# Keys tried, in order, to find a place's ID and name in an upstream result
+ID_KEYS = ('id', 'locid', 'location_id', 'value')
+NAME_KEYS = ('name', 'label', 'place', 'city', 'value')
+
+def normalize_query(text):
+    """Lowercase and collapse whitespace so equivalent queries share a key"""
+    return ' '.join(text.lower().split())
+
+def search_locations(city):
+    """
+    Find places matching ``city``, answering from the local index when possible
+
+    Repeated queries are served from their cached upstream answer, and
+    queries extending one whose answer was complete (shorter than
+    UPSTREAM_PLACE_QUERY_LIMIT) or a prefix a seed file covers from a prefix
+    search of the places seen so far. Only queries none of these can answer
+    go to upstream, whose answer is then indexed.
+
+    Args:
+        city (str): Place name, or the start of one
+
+    Returns:
+        list: Place objects in the shape upstream returns them
+
+    Raises:
+        requests.RequestException: If upstream had to be asked and failed
+    """
+    key = _query_key(city)
+    results, stale = _search_local(key)
+    if results is not None:
+        return results
+
+    try:
+        response = fetch_upstream(current_app.config['PLACE_QUERY_URL'], {'place': city})
+    except requests.RequestException:
+        # An outdated answer beats none while upstream is down
+        if stale is not None:
+            return stale
+        raise
+    return _save_query(key, response.text)
+
+async def search_locations_async(city):
+    """Async version of ``search_locations``; database access runs on worker threads"""
+    key = _query_key(city)
+    results, stale = await run_in_db_thread(_search_local, key)
+    if results is not None:
+        return results
+
+    try:
+        response = await fetch_upstream_async(current_app.config['PLACE_QUERY_URL'], {'place': city})
+    except requests.RequestException:
+        # An outdated answer beats none while upstream is down
+        if stale is not None:
+            return stale
+        raise
+    return await run_in_db_thread(_save_query, key, response.text)
+
+def _query_key(city):
+    return normalize_query(city)[:LocationQuery.query_key.type.length]
+
+def _search_local(key):
+    """
+    Answer a query from the local index
+
+    Returns:
+        tuple: Results, or None if upstream must be asked, and the expired
+        cached answer for the query, if any
+    """
+    limit = current_app.config['LOCATION_SEARCH_LIMIT']
+    fresh_since = datetime.utcnow() - timedelta(seconds=current_app.config['LOCATION_QUERY_TTL'])
+    cached = db.session.get(LocationQuery, key)
+    if cached is not None and cached.fetched_at > fresh_since:
+        return json.loads(cached.response), None
+    stale = json.loads(cached.response) if cached is not None else None
+
+    # The index only knows the places earlier answers and seed files
+    # contained, so it may answer for a query only if every match of it is
+    # known: a seed file covered a prefix of it, or a shorter prefix was
+    # asked upstream and got an answer that wasn't cut off
+    if not _is_covered(key, fresh_since):
+        return None, stale
+
+    matches = Location.query.filter(
+        Location.name_key >= key,
+        Location.name_key < key + '\uffff'
+    ).order_by(Location.name_key).limit(limit).all()
+    return [json.loads(location.payload) for location in matches], None
+
+def _is_covered(key, fresh_since):
+    seeded = db.session.query(LocationCoverage.prefix).filter(
+        LocationCoverage.prefix.in_([key[:length] for length in range(len(key) + 1)])
+    ).first()
+    if seeded is not None:
+        return True
+    upstream_limit = current_app.config['UPSTREAM_PLACE_QUERY_LIMIT']
+    prefixes = LocationQuery.query.filter(
+        LocationQuery.query_key.in_([key[:length] for length in range(1, len(key))]),
+        LocationQuery.fetched_at > fresh_since
+    )
+    return any(len(json.loads(prefix.response)) < upstream_limit for prefix in prefixes)
+
+def _save_query(key, text):
+    """Cache an upstream answer under ``key``, index its places and return them"""
+    try:
+        results = json.loads(text) if text.strip() else []
+    except ValueError:
+        # If JSON parsing fails, treat it as no results
+        results = []
+    if not isinstance(results, list):
+        results = []
+
+    db.session.merge(LocationQuery(
+        query_key=key,
+        response=json.dumps(results),
+        fetched_at=datetime.utcnow()
+    ))
+    index_locations(results)
+    db.session.commit()
+    return results
+
+def _first(place, keys):
+    for key in keys:
+        value = place.get(key)
+        if value not in (None, ''):
+            return str(value)
+    return None
+
+def index_locations(places):
+    """Add or update upstream-shaped place objects in the local index; the caller commits"""
+    count = 0
+    for place in places:
+        if not isinstance(place, dict):
+            continue
+        location_id = _first(place, ID_KEYS)
+        name = _first(place, NAME_KEYS)
+        if location_id is None or name is None:
+            continue
+        db.session.merge(Location(
+            location_id=location_id[:Location.location_id.type.length],
+            name=name,
+            name_key=normalize_query(name)[:Location.name_key.type.length],
+            payload=json.dumps(place)
+        ))
+        count += 1
+    return count
+
+@click.command('load-locations')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--prefix', 'prefixes', multiple=True,
+              help='Name prefix the file lists every place for; repeatable.')
+@click.option('--complete', is_flag=True, help='The file lists every place.')
+@with_appcontext
+def load_locations_command(path, prefixes, complete):
+    """Bulk-load places into the location index from a JSON Lines file
+
+    Each line is a place object in the shape placequery.php returns. Queries
+    starting with a --prefix (any query, with --complete) are then answered
+    from the index without asking upstream.
+    """
+    with open(path, encoding='utf-8') as f:
+        places = [json.loads(line) for line in f if line.strip()]
+    count = index_locations(places)
+    covered = {''} if complete else {
+        normalize_query(prefix)[:LocationCoverage.prefix.type.length] for prefix in prefixes
+    }
+    for prefix in covered:
+        db.session.merge(LocationCoverage(prefix=prefix, loaded_at=datetime.utcnow()))
+    db.session.commit()
+    click.echo(f"Indexed {count} locations")
+    if covered:
+        click.echo(f"Recorded coverage of {len(covered)} name prefixes")
@@ -0,0 +1,233 @@
+"""In-process metrics rendered in the Prometheus text exposition format"""
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+class CollectedCounter(Gauge):
+    """Counter whose running totals are kept elsewhere and copied in by a collector"""
+    kind = 'counter'
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # Per-bucket counts, then total count and sum
+                counts = self._values[key] = [0] * len(self.buckets) + [0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall-clock duration of the ``with`` block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for labels, counts in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    bucket_labels = labels + (('le', bound),)
+                    lines.append(f"{self.name}_bucket{_format_labels(bucket_labels)} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {counts[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {counts[-2]}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {counts[-1]}")
+        return lines
+
+class Registry:
+    """Holds metrics and callbacks that refresh collected metrics just before rendering"""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self.register(Counter(name, help))
+
+    def gauge(self, name, help):
+        return self.register(Gauge(name, help))
+
+    def collected_counter(self, name, help):
+        return self.register(CollectedCounter(name, help))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        for collector in self.collectors:
+            collector()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+# Stage timings
+upstream_request_seconds = registry.histogram(
+    'pypanchang_upstream_request_seconds', 'Upstream HTTP request duration')
+parse_seconds = registry.histogram(
+    'pypanchang_parse_seconds', 'Panchang feed parse duration')
+render_seconds = registry.histogram(
+    'pypanchang_render_seconds', 'Email HTML render duration')
+smtp_send_seconds = registry.histogram(
+    'pypanchang_smtp_send_seconds', 'Duration of sending one email over SMTP')
+db_commit_seconds = registry.histogram(
+    'pypanchang_db_commit_seconds', 'Duration of database commits made by jobs')
+job_run_seconds = registry.histogram(
+    'pypanchang_job_run_seconds', 'Duration of scheduled job runs', buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600))
+
+# Counters
+upstream_requests_total = registry.counter(
+    'pypanchang_upstream_requests_total', 'Upstream HTTP requests by outcome')
+emails_sent_total = registry.counter(
+    'pypanchang_emails_sent_total', 'Emails sent')
+emails_failed_total = registry.counter(
+    'pypanchang_emails_failed_total', 'Emails that failed to send')
+cache_events_total = registry.collected_counter(
+    'pypanchang_cache_events_total', 'Cache hits, misses and evictions, by cache and tier')
+upstream_circuit_events_total = registry.collected_counter(
+    'pypanchang_upstream_circuit_events_total',
+    'Upstream calls rejected by the circuit breaker and calls that succeeded or failed, by host')
+
+# Gauges
+last_run_duration_seconds = registry.gauge(
+    'pypanchang_job_last_run_duration_seconds', 'Duration of the latest run of each job')
+last_run_emails = registry.gauge(
+    'pypanchang_job_last_run_emails',
+    'Emails sent and failed, and messages deferred, in the latest email job run')
+last_run_throughput = registry.gauge(
+    'pypanchang_job_last_run_emails_per_second', 'Emails sent per second in the latest email job run')
+cache_entries = registry.gauge(
+    'pypanchang_cache_entries', 'Entries held, by cache and tier')
+upstream_circuit = registry.gauge(
+    'pypanchang_upstream_circuit', 'Upstream circuit breaker state, calls in flight and rate limit tokens, by host')
+outbox_messages = registry.gauge(
+    'pypanchang_outbox_messages', 'Email outbox messages by status')
+
+def collect_app_metrics():
+    """Refresh cache, upstream and outbox metrics from the current app's state"""
+    from flask import current_app
+    from app.models import db, OutboxMessage
+    from app.upstream import upstream_status
+
+    for cache_name in ('panchang_cache', 'rendered_email_cache', 'api_token_cache'):
+        cache = current_app.extensions.get(cache_name)
+        if cache is None:
+            continue
+        stats = cache.stats()
+        # Tiered caches report {tier: stats}, single caches report stats
+        tiers = stats if all(isinstance(value, dict) for value in stats.values()) else {'memory': stats}
+        for tier, tier_stats in tiers.items():
+            for event in ('hits', 'misses', 'evictions'):
+                cache_events_total.set(tier_stats[event], cache=cache_name, tier=tier, event=event)
+            cache_entries.set(tier_stats['entries'], cache=cache_name, tier=tier)
+
+    for host, state in upstream_status().items():
+        for key, value in state.items():
+            if key == 'state':
+                for circuit_state in ('closed', 'open', 'half_open'):
+                    upstream_circuit.set(int(value == circuit_state), host=host, stat=f'state_{circuit_state}')
+            elif key in ('rejected', 'successes', 'failures'):
+                upstream_circuit_events_total.set(value, host=host, event=key)
+            else:
+                upstream_circuit.set(value, host=host, stat=key)
+
+    counts = dict(db.session.query(OutboxMessage.status, db.func.count()).group_by(OutboxMessage.status))
+    for status in (OutboxMessage.PENDING, OutboxMessage.SENT, OutboxMessage.FAILED, OutboxMessage.DEAD):
+        outbox_messages.set(counts.get(status, 0), status=status)
+
+registry.add_collector(collect_app_metrics)
+
+class RunStats:
+    """Summary of one email job run"""
+
+    def __init__(self, job):
+        self.job = job
+        self.started_at = time.perf_counter()
+        self.duration = None
+        self.sent = 0  # Emails, each covering one or more messages
+        self.failed = 0
+        self.deferred = 0  # Messages waiting for their panchang; not attempts
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started_at
+        job_run_seconds.observe(self.duration, job=self.job)
+        last_run_duration_seconds.set(self.duration, job=self.job)
+        last_run_emails.set(self.sent, job=self.job, outcome='sent')
+        last_run_emails.set(self.failed, job=self.job, outcome='failed')
+        last_run_emails.set(self.deferred, job=self.job, outcome='deferred')
+        last_run_throughput.set(self.throughput, job=self.job)
+        return self
+
+    @property
+    def throughput(self):
+        return self.sent / self.duration if self.duration else 0.0
+
+    def summary(self):
+        return (
+            f"{self.job}: sent {self.sent}, failed {self.failed} emails, deferred {self.deferred} messages in "
+            f"{self.duration:.2f}s ({self.throughput:.1f} emails/s)"
+        )
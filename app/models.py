@@ -1,7 +1,66 @@
+import asyncio
+import click
+from flask import current_app
+from flask.cli import with_appcontext
 from flask_login import UserMixin
-from datetime import datetime
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
 import secrets
+import zlib
+from dataclasses import fields
 from app import db, login_manager
+from app.cache import get_api_token_cache
+from app.parser import PARSER_VERSION, PanchangData, parse_time_range
+
+@click.command('init-db')
+@with_appcontext
+def init_db_command():
+    """Create any missing database tables, columns and indexes"""
+    db.create_all()
+    # create_all skips tables that exist, so columns and indexes added to
+    # them later are created here
+    _add_missing_columns()
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    click.echo("Initialized the database")
+
+def _add_missing_columns():
+    """Add columns of the models that existing tables lack
+    
+    New NOT NULL columns need a server_default, which fills existing rows.
+    """
+    inspector = db.inspect(db.engine)
+    compiler = db.engine.dialect.ddl_compiler(db.engine.dialect, None)
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                if not column.nullable and column.server_default is None:
+                    raise click.ClickException(
+                        f"Cannot add NOT NULL column {table.name}.{column.name} without a server default"
+                    )
+                connection.execute(db.text(
+                    f"ALTER TABLE {compiler.preparer.format_table(table)} "
+                    f"ADD COLUMN {compiler.get_column_specification(column)}"
+                ))
+                click.echo(f"Added column {table.name}.{column.name}")
+
+async def run_in_db_thread(func, *args):
+    """Run blocking database work from a coroutine on a worker thread
+    
+    The session is closed afterwards, so its pooled connection isn't held
+    while the coroutine awaits something else.
+    """
+    def call():
+        try:
+            return func(*args)
+        finally:
+            db.session.close()
+    return await asyncio.to_thread(call)
 
 @login_manager.user_loader
 def load_user(id):
@@ -19,18 +78,67 @@ class User(UserMixin, db.Model):
 
     def generate_api_token(self):
         """Generate a new API token for the user"""
+        old_token = self.api_token
         self.api_token = secrets.token_hex(32)
         db.session.commit()
+        if old_token:
+            get_api_token_cache().delete(old_token)
         return self.api_token
 
     @staticmethod
     def verify_api_token(token):
-        """Verify an API token and return the associated user"""
+        """Verify an API token and return the associated user
+        
+        Verified tokens are cached for API_TOKEN_CACHE_TTL seconds; a cache
+        hit attaches the cached user to the session without a query.
+        """
         if not token:
             return None
-        return User.query.filter_by(api_token=token).first()
+        
+        cache = get_api_token_cache()
+        cached = cache.get(token)
+        if cached is not None:
+            return db.session.merge(cached, load=False)
+        
+        user = User.query.filter_by(api_token=token).first()
+        if user is not None:
+            cache.set(token, user._detached_copy())
+        return user
+
+    def _detached_copy(self):
+        """Return a session-less copy of this user's column values"""
+        copy = User(**{column.key: getattr(self, column.key) for column in User.__table__.columns})
+        make_transient_to_detached(copy)
+        return copy
 
 class Subscription(db.Model):
+    __table_args__ = (
+        # Lets the dispatcher page through a time zone's subscriptions in id
+        # order, checking due and not yet sent today from the index alone
+        db.Index(
+            'ix_subscription_due',
+            'is_active', 'timezone', 'id', 'delivery_time', 'last_sent'
+        ),
+        # Lets the dispatcher add a batch's recipients' other due
+        # subscriptions without scanning the time zone
+        db.Index(
+            'ix_subscription_recipient',
+            'email', 'is_active', 'timezone', 'last_sent'
+        ),
+        # Covers a user's subscription list and the duplicate checks of
+        # subscribe and bulk import
+        db.Index(
+            'ix_subscription_owner',
+            'user_id', 'is_active', 'location_id', 'email'
+        ),
+        # Lets the prefetch job list subscribed (location, time zone) pairs
+        # from the index alone
+        db.Index(
+            'ix_subscription_location',
+            'is_active', 'location_id', 'timezone'
+        ),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     location_id = db.Column(db.String(20), nullable=False)
@@ -38,4 +146,380 @@ class Subscription(db.Model):
     email = db.Column(db.String(120), nullable=False)  # Email to receive panchang
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    last_sent = db.Column(db.DateTime) 
\ No newline at end of file
+    last_sent = db.Column(db.DateTime)
+    # IANA time zone name and local time of day the email goes out at. The
+    # delivery time is aligned to the start of a SCHEDULER_SLOT_MINUTES slot.
+    # The server defaults fill rows created before these columns existed.
+    timezone = db.Column(
+        db.String(64), nullable=False,
+        default=lambda: current_app.config['DEFAULT_TIMEZONE'],
+        server_default='Asia/Kolkata'
+    )
+    delivery_time = db.Column(
+        db.Time, nullable=False,
+        default=lambda: current_app.config['DEFAULT_DELIVERY_TIME'],
+        server_default='06:00:00'
+    )
+
+class OutboxMessage(db.Model):
+    """One panchang email to deliver, retried with backoff until sent or dead
+    
+    Rows are created pending by the email job and delivered by whichever
+    worker claims them. A failed attempt schedules the next one
+    OUTBOX_RETRY_BACKOFF * 2**(attempts - 1) seconds later; after
+    OUTBOX_MAX_ATTEMPTS the message is dead and left for inspection.
+    """
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    DEAD = 'dead'
+    # Delivery outcome (not a status) of a message whose panchang isn't
+    # fetched yet; it is tried again later without using up an attempt
+    DEFERRED = object()
+    
+    __table_args__ = (
+        db.UniqueConstraint('subscription_id', 'local_date'),
+        # Lets workers find deliverable messages in due order
+        db.Index('ix_outbox_message_due', 'status', 'next_attempt_at'),
+        # Lets a claim take the rest of its recipients' messages
+        db.Index('ix_outbox_message_recipient', 'email', 'status'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    subscription_id = db.Column(db.Integer, db.ForeignKey('subscription.id'), nullable=False)
+    location_id = db.Column(db.String(20), nullable=False)
+    city_name = db.Column(db.String(120), nullable=False)
+    email = db.Column(db.String(120), nullable=False)
+    local_date = db.Column(db.Date, nullable=False)  # Day whose panchang is sent
+    status = db.Column(db.String(10), nullable=False, default=PENDING)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # Set while a worker is delivering the message; an expired claim can be
+    # taken over, so a crashed worker's messages are retried
+    claim_token = db.Column(db.String(32))
+    claimed_until = db.Column(db.DateTime)
+    last_error = db.Column(db.String(500))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+    
+    @staticmethod
+    def claim(token, limit, ttl):
+        """Claim about ``limit`` due messages for ``ttl`` seconds under ``token``
+        
+        All due messages of the selected messages' recipients are claimed,
+        so they can be sent as one email; a claim may therefore hold more
+        than ``limit``.
+        
+        Returns:
+            list: Column rows (id, location_id, local_date, city_name, email)
+        """
+        now = datetime.utcnow()
+        claimable = db.and_(
+            OutboxMessage.status.in_((OutboxMessage.PENDING, OutboxMessage.FAILED)),
+            OutboxMessage.next_attempt_at <= now,
+            db.or_(OutboxMessage.claimed_until.is_(None), OutboxMessage.claimed_until < now)
+        )
+        # FOR UPDATE SKIP LOCKED on Postgres, so concurrent workers pass over
+        # each other's candidates; SQLite ignores it and serializes writers
+        ids = [
+            id for (id,) in db.session.query(OutboxMessage.id)
+            .filter(claimable)
+            .order_by(OutboxMessage.next_attempt_at)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        ]
+        if not ids:
+            db.session.rollback()
+            return []
+        # Extend the claim to the selected recipients' other due messages
+        emails = {
+            email for (email,) in
+            db.session.query(OutboxMessage.email).filter(OutboxMessage.id.in_(ids))
+        }
+        
+        # One UPDATE takes every claimable message of each recipient, so two
+        # workers can't split a recipient's messages between them (without
+        # SKIP LOCKED, both may have selected the same candidates)
+        claimed_until = now + timedelta(seconds=ttl)
+        OutboxMessage.query.filter(OutboxMessage.email.in_(emails), claimable).update(
+            {'claim_token': token, 'claimed_until': claimed_until},
+            synchronize_session=False
+        )
+        db.session.commit()
+        return db.session.query(
+            OutboxMessage.id,
+            OutboxMessage.location_id,
+            OutboxMessage.local_date,
+            OutboxMessage.city_name,
+            OutboxMessage.email
+        ).filter(
+            OutboxMessage.email.in_(emails),
+            OutboxMessage.claim_token == token,
+            # Not messages claimed earlier under the token, still in flight
+            OutboxMessage.claimed_until == claimed_until,
+            OutboxMessage.status.in_((OutboxMessage.PENDING, OutboxMessage.FAILED))
+        ).all()
+    
+    @staticmethod
+    def renew(token, ttl):
+        """Extend the claim on messages still held under ``token`` by ``ttl`` seconds
+        
+        A lapsed claim that no other worker has taken over is renewed too.
+        
+        Returns:
+            int: Number of messages still held
+        """
+        renewed = OutboxMessage.query.filter(
+            OutboxMessage.claim_token == token,
+            OutboxMessage.status.in_((OutboxMessage.PENDING, OutboxMessage.FAILED))
+        ).update(
+            {'claimed_until': datetime.utcnow() + timedelta(seconds=ttl)},
+            synchronize_session=False
+        )
+        db.session.commit()
+        return renewed
+    
+    @staticmethod
+    def cancel_for_subscription(subscription_id):
+        """Mark the undelivered messages of a subscription dead; the caller commits
+        
+        Their claims are dropped too, so a worker sending one right now
+        can't record it afterwards.
+        """
+        OutboxMessage.query.filter(
+            OutboxMessage.subscription_id == subscription_id,
+            OutboxMessage.status.in_((OutboxMessage.PENDING, OutboxMessage.FAILED))
+        ).update({
+            'status': OutboxMessage.DEAD,
+            'last_error': 'Unsubscribed',
+            'claim_token': None,
+            'claimed_until': None
+        }, synchronize_session=False)
+    
+    @staticmethod
+    def record(token, results, max_attempts, backoff, max_defer_days):
+        """Record delivery outcomes of messages claimed under ``token``
+        
+        Args:
+            results (list): (message id, error) pairs, error None if sent or
+                DEFERRED if it couldn't be tried yet
+            max_attempts (int): Attempts after which a failing message is dead
+            backoff (float): Seconds before the first retry, doubling
+                afterwards; deferred messages are tried again after this long
+            max_defer_days (int): Days after its local date a deferred
+                message is given up on and marked dead
+        
+        Returns:
+            int: Number of outcomes that could not be recorded because the
+                message was claimed by another worker or cancelled in the
+                meantime
+        """
+        now = datetime.utcnow()
+        # A lapsed claim still holds the message until another worker takes
+        # it over, which replaces the token
+        held = OutboxMessage.claim_token == token
+        released = {'claim_token': None, 'claimed_until': None}
+        recorded = 0
+        
+        deferred_ids = [id for id, error in results if error is OutboxMessage.DEFERRED]
+        if deferred_ids:
+            # A daily email is pointless days late
+            too_late = OutboxMessage.local_date < now.date() - timedelta(days=max_defer_days)
+            recorded += OutboxMessage.query.filter(
+                OutboxMessage.id.in_(deferred_ids), held, too_late
+            ).update(
+                dict(released, status=OutboxMessage.DEAD,
+                     last_error='No panchang available before the deferral cutoff'),
+                synchronize_session=False
+            )
+            recorded += OutboxMessage.query.filter(
+                OutboxMessage.id.in_(deferred_ids), held, db.not_(too_late)
+            ).update(
+                dict(released, next_attempt_at=now + timedelta(seconds=backoff)),
+                synchronize_session=False
+            )
+        
+        sent_ids = [id for id, error in results if error is None]
+        if sent_ids:
+            recorded += OutboxMessage.query.filter(OutboxMessage.id.in_(sent_ids), held).update(
+                dict(released, status=OutboxMessage.SENT, sent_at=now, last_error=None,
+                     attempts=OutboxMessage.attempts + 1),
+                synchronize_session=False
+            )
+        
+        errors = {
+            id: error for id, error in results
+            if error is not None and error is not OutboxMessage.DEFERRED
+        }
+        if errors:
+            failed = db.session.query(OutboxMessage.id, OutboxMessage.attempts).filter(
+                OutboxMessage.id.in_(errors), held
+            )
+            for id, attempts in failed.all():
+                recorded += 1
+                attempts += 1
+                status = OutboxMessage.DEAD if attempts >= max_attempts else OutboxMessage.FAILED
+                OutboxMessage.query.filter_by(id=id).update(dict(
+                    released,
+                    status=status,
+                    attempts=attempts,
+                    last_error=errors[id][:500],
+                    next_attempt_at=now + timedelta(seconds=backoff * 2 ** (attempts - 1))
+                ), synchronize_session=False)
+        db.session.commit()
+        return len(results) - recorded
+
+class PanchangDay(db.Model):
+    """Parsed panchang for one location and date, stored once per fetch
+    
+    Text fields hold the lines as parsed; the main time windows are also
+    kept as time columns so they can be queried. The feed HTML is kept
+    zlib-compressed so rows can be reparsed when the parser changes.
+    """
+    # Parsed line -> (start, end) time columns
+    TIME_RANGES = {
+        'sunrise_sunset': ('sunrise', 'sunset'),
+        'moonrise_moonset': ('moonrise', 'moonset'),
+        'rahukalam': ('rahukalam_start', 'rahukalam_end'),
+        'yamagandam': ('yamagandam_start', 'yamagandam_end'),
+        'gulikai': ('gulikai_start', 'gulikai_end'),
+        'abhijit': ('abhijit_start', 'abhijit_end'),
+    }
+    
+    # The composite primary key also serves date range queries per location
+    location_id = db.Column(db.String(20), primary_key=True)
+    date = db.Column(db.Date, primary_key=True)
+    location = db.Column(db.String(200), nullable=False, default='')
+    date_line = db.Column(db.String(200), nullable=False, default='')  # PanchangData.date
+    shaka = db.Column(db.String(200), nullable=False, default='')
+    vikrami_north = db.Column(db.String(200), nullable=False, default='')
+    vikrami_gujarat = db.Column(db.String(200), nullable=False, default='')
+    sunrise_sunset = db.Column(db.String(200), nullable=False, default='')
+    moonrise_moonset = db.Column(db.String(200), nullable=False, default='')
+    tamil = db.Column(db.String(200), nullable=False, default='')
+    paksha = db.Column(db.String(200), nullable=False, default='')
+    tithi = db.Column(db.JSON, nullable=False, default=list)
+    nakshatra = db.Column(db.JSON, nullable=False, default=list)
+    yoga = db.Column(db.JSON, nullable=False, default=list)
+    karana = db.Column(db.JSON, nullable=False, default=list)
+    rahukalam = db.Column(db.String(200), nullable=False, default='')
+    yamagandam = db.Column(db.String(200), nullable=False, default='')
+    gulikai = db.Column(db.String(200), nullable=False, default='')
+    abhijit = db.Column(db.String(200), nullable=False, default='')
+    durmuhurtham = db.Column(db.String(200), nullable=False, default='')
+    varjyam = db.Column(db.String(200), nullable=False, default='')
+    amritkalam = db.Column(db.String(200), nullable=False, default='')
+    sun = db.Column(db.String(200), nullable=False, default='')
+    moon = db.Column(db.String(200), nullable=False, default='')
+    sayana_sun = db.Column(db.String(200), nullable=False, default='')
+    sun_star = db.Column(db.String(200), nullable=False, default='')
+    dikshoolai = db.Column(db.String(200), nullable=False, default='')
+    kaal_vaasa = db.Column(db.String(200), nullable=False, default='')
+    rahu_vaasa = db.Column(db.String(200), nullable=False, default='')
+    agnivasa = db.Column(db.String(200), nullable=False, default='')
+    moon_abode = db.Column(db.JSON, nullable=False, default=list)
+    shraddha_tithi = db.Column(db.String(200), nullable=False, default='')
+    other = db.Column(db.JSON, nullable=False, default=list)
+    sunrise = db.Column(db.Time)
+    sunset = db.Column(db.Time)
+    moonrise = db.Column(db.Time)
+    moonset = db.Column(db.Time)
+    rahukalam_start = db.Column(db.Time)
+    rahukalam_end = db.Column(db.Time)
+    yamagandam_start = db.Column(db.Time)
+    yamagandam_end = db.Column(db.Time)
+    gulikai_start = db.Column(db.Time)
+    gulikai_end = db.Column(db.Time)
+    abhijit_start = db.Column(db.Time)
+    abhijit_end = db.Column(db.Time)
+    raw_payload = db.Column(db.LargeBinary, nullable=False)  # zlib-compressed feed HTML
+    fetched_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # PARSER_VERSION the fields were parsed with
+    parser_version = db.Column(db.Integer, nullable=False, default=PARSER_VERSION, server_default='1')
+    
+    @staticmethod
+    def _column_for(field_name):
+        return 'date_line' if field_name == 'date' else field_name
+    
+    def set_parsed(self, parsed):
+        """Copy the fields of a PanchangData made by the current parser onto this row"""
+        self.parser_version = PARSER_VERSION
+        for field in fields(parsed):
+            setattr(self, self._column_for(field.name), getattr(parsed, field.name))
+        for field_name, (start_column, end_column) in self.TIME_RANGES.items():
+            start, end = parse_time_range(getattr(parsed, field_name))
+            setattr(self, start_column, start)
+            setattr(self, end_column, end)
+    
+    def to_panchang_data(self):
+        """Return the stored fields as a PanchangData"""
+        return PanchangData(**{
+            field.name: getattr(self, self._column_for(field.name))
+            for field in fields(PanchangData)
+        })
+    
+    @property
+    def raw_data(self):
+        return zlib.decompress(self.raw_payload).decode('utf-8')
+    
+    @raw_data.setter
+    def raw_data(self, value):
+        self.raw_payload = zlib.compress(value.encode('utf-8'))
+
+class Location(db.Model):
+    """A place known from upstream place queries or a seed file"""
+    location_id = db.Column(db.String(20), primary_key=True)
+    name = db.Column(db.String(200), nullable=False)
+    # Normalized name; prefix searches are range scans on this index
+    name_key = db.Column(db.String(200), nullable=False, index=True)
+    payload = db.Column(db.Text, nullable=False)  # Place object as returned upstream
+
+class LocationQuery(db.Model):
+    """Upstream answer to a place query, keyed by the normalized query"""
+    query_key = db.Column(db.String(200), primary_key=True)
+    response = db.Column(db.Text, nullable=False)  # JSON list as returned upstream
+    fetched_at = db.Column(db.DateTime, nullable=False)
+
+class LocationCoverage(db.Model):
+    """Normalized name prefix for which the index holds every place
+    
+    Recorded when a seed file that lists every such place is loaded, so
+    queries starting with the prefix are answered without asking upstream.
+    """
+    prefix = db.Column(db.String(200), primary_key=True)
+    loaded_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class JobLock(db.Model):
+    """Lease that lets exactly one process run a scheduled job at a time"""
+    name = db.Column(db.String(64), primary_key=True)
+    owner = db.Column(db.String(120), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    @staticmethod
+    def acquire(name, owner, ttl):
+        """Take or renew the lease on ``name`` for ``ttl`` seconds; return True if held"""
+        now = datetime.utcnow()
+        expires_at = now + timedelta(seconds=ttl)
+        # A single conditional UPDATE, so two processes can't both win an expired lease
+        updated = JobLock.query.filter(
+            JobLock.name == name,
+            db.or_(JobLock.expires_at < now, JobLock.owner == owner)
+        ).update({'owner': owner, 'expires_at': expires_at}, synchronize_session=False)
+        if updated:
+            db.session.commit()
+            return True
+        
+        try:
+            db.session.add(JobLock(name=name, owner=owner, expires_at=expires_at))
+            db.session.commit()
+            return True
+        except IntegrityError:
+            # Someone else holds an unexpired lease
+            db.session.rollback()
+            return False
+
+    @staticmethod
+    def release(name, owner):
+        """Give up the lease on ``name`` if ``owner`` holds it"""
+        JobLock.query.filter_by(name=name, owner=owner).delete(synchronize_session=False)
+        db.session.commit()
@@ -1,6 +1,14 @@
+import click
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from flask import current_app
+from flask.cli import with_appcontext
 from datetime import datetime
+from sqlalchemy.exc import SQLAlchemyError
+from app import metrics
+from app.cache import get_panchang_cache, panchang_cache_key
+from app.parser import PARSER_VERSION, parse_panchang
+from app.upstream import fetch_upstream, fetch_upstream_async
 
 def get_panchang_data(location_id, date=None):
     """
@@ -16,32 +24,266 @@ def get_panchang_data(location_id, date=None):
     if date is None:
         date = datetime.now()
     
-    params = {
+    cached = get_cached_panchang_data(location_id, date)
+    if cached is not None:
+        return cached
+    
+    return _fetch_panchang_data(location_id, date)
+
+def get_cached_panchang_data(location_id, date):
+    """Return panchang data for a location and date only if it is cached or stored"""
+    key = (location_id, date.strftime('%Y-%m-%d'))
+    cached = get_panchang_cache().get(panchang_cache_key(*key))
+    if cached is not None:
+        return cached
+    return get_stored_panchang_data([key]).get(key)
+
+def get_stored_panchang_data(keys):
+    """
+    Load panchang data from the PanchangDay table, without any HTML parsing
+    
+    Loaded days are added to the panchang cache. Days stored by an older
+    parser version are parsed again from their feed.
+    
+    Args:
+        keys (iterable): (location_id, 'YYYY-MM-DD') pairs
+    
+    Returns:
+        dict: Mapping of the pairs found to panchang data
+    """
+    from app.models import PanchangDay
+    
+    keys = set(keys)
+    if not keys:
+        return {}
+    dates = {datetime.strptime(date, '%Y-%m-%d').date() for _, date in keys}
+    rows = PanchangDay.query.filter(
+        PanchangDay.location_id.in_({location_id for location_id, _ in keys}),
+        PanchangDay.date.in_(dates)
+    )
+    
+    cache = get_panchang_cache()
+    found = {}
+    for row in rows:
+        key = (row.location_id, row.date.strftime('%Y-%m-%d'))
+        if key not in keys:
+            continue
+        if row.parser_version == PARSER_VERSION:
+            parsed = row.to_panchang_data()
+        else:
+            with metrics.parse_seconds.time():
+                parsed = parse_panchang(row.raw_data)
+        found[key] = {
+            'raw_data': row.raw_data,
+            'location_id': row.location_id,
+            'date': key[1],
+            'panchang': parsed.to_dict()
+        }
+        cache.set(panchang_cache_key(*key), found[key])
+    return found
+
+def _store_panchang_day(location_id, date, parsed, raw_data):
+    """Insert or replace the PanchangDay row for a location and date"""
+    from app.models import db, PanchangDay
+    
+    try:
+        day = PanchangDay(location_id=location_id, date=date.date() if isinstance(date, datetime) else date)
+        day.set_parsed(parsed)
+        day.raw_data = raw_data
+        day.fetched_at = datetime.utcnow()
+        db.session.merge(day)
+        db.session.commit()
+    except SQLAlchemyError as e:
+        # The cache still has the day; storing it is retried on the next fetch
+        db.session.rollback()
+        current_app.logger.error(f"Error storing panchang for location {location_id}: {str(e)}")
+    except Exception as e:
+        # Splitting the parsed fields into columns failed; the fetched day is
+        # still served and cached, and the next fetch tries storing it again
+        db.session.rollback()
+        current_app.logger.exception(f"Error storing parsed panchang for location {location_id}: {str(e)}")
+
+def _panchang_params(location_id, date):
+    return {
         'locid': location_id,
         'dt': date.day,
         'mn': date.month,
         'yr': date.year
     }
+
+def _fetch_panchang_data(location_id, date):
+    """Fetch panchang data from upstream and store it in the cache"""
+    try:
+        response = fetch_upstream(current_app.config['PANCHANG_API_BASE_URL'], _panchang_params(location_id, date))
+    except requests.RequestException as e:
+        return _stale_panchang_data(location_id, date, e)
+    return _save_panchang_data(location_id, date, response.text)
+
+async def get_panchang_data_async(location_id, date=None):
+    """
+    Async version of ``get_panchang_data`` for the ASGI endpoints
+
+    Only the upstream call is made on the event loop; cache and database
+    access, including the stale fallback, run on worker threads.
+    """
+    from app.models import run_in_db_thread
+    
+    if date is None:
+        date = datetime.now()
+    
+    cached = await run_in_db_thread(get_cached_panchang_data, location_id, date)
+    if cached is not None:
+        return cached
     
     try:
-        response = requests.get(
-            current_app.config['PANCHANG_API_BASE_URL'],
-            params=params
+        response = await fetch_upstream_async(
+            current_app.config['PANCHANG_API_BASE_URL'], _panchang_params(location_id, date)
         )
-        response.raise_for_status()
-        
-        # Parse the response text and extract relevant information
-        # This is a basic implementation - you might want to add more sophisticated parsing
-        data = response.text
-        
-        # TODO: Add proper parsing of the response data
-        # For now, returning the raw text
-        return {
-            'raw_data': data,
-            'location_id': location_id,
-            'date': date.strftime('%Y-%m-%d')
-        }
-        
     except requests.RequestException as e:
-        current_app.logger.error(f"Error fetching panchang data: {str(e)}")
-        return None 
\ No newline at end of file
+        # The durable cache tier is read synchronously
+        return await run_in_db_thread(_stale_panchang_data, location_id, date, e)
+    return await run_in_db_thread(_save_panchang_data, location_id, date, response.text)
+
+def _save_panchang_data(location_id, date, data):
+    """Parse a fetched feed, store it in the table and cache, and return it"""
+    # Parse the response once; consumers use the parsed fields
+    with metrics.parse_seconds.time():
+        parsed = parse_panchang(data)
+    
+    result = {
+        'raw_data': data,
+        'location_id': location_id,
+        'date': date.strftime('%Y-%m-%d'),
+        'panchang': parsed.to_dict()
+    }
+    _store_panchang_day(location_id, date, parsed, data)
+    get_panchang_cache().set(panchang_cache_key(location_id, result['date']), result)
+    return result
+
+def _stale_panchang_data(location_id, date, error):
+    """Return expired cached data after upstream failed with ``error``, or None"""
+    # Past TTL is still correct for a day that has already been fetched
+    stale = get_panchang_cache().get_stale(panchang_cache_key(location_id, date.strftime('%Y-%m-%d')))
+    if stale is not None:
+        current_app.logger.warning(f"Serving stale panchang data, upstream failed: {str(error)}")
+        return stale
+    current_app.logger.error(f"Error fetching panchang data: {str(error)}")
+    return None
+
+def iter_panchang_data_many(items):
+    """
+    Fetch panchang data for many (location_id, date) pairs concurrently
+
+    Cached and stored pairs are yielded first; the rest are fetched on a
+    bounded thread pool and yielded as they complete. Duplicate pairs are
+    fetched once.
+
+    Args:
+        items (iterable): (location_id, date) pairs. A date of None means the current date.
+
+    Yields:
+        tuple: ((location_id, 'YYYY-MM-DD'), dict or None)
+    """
+    app = current_app._get_current_object()
+    cache = get_panchang_cache()
+    now = datetime.now()
+
+    pending = {}
+    for location_id, date in items:
+        date = date or now
+        key = (location_id, date.strftime('%Y-%m-%d'))
+        if key in pending:
+            continue
+        cached = cache.get(panchang_cache_key(*key))
+        if cached is not None:
+            pending[key] = None
+            yield key, cached
+        else:
+            pending[key] = date
+
+    # Misses in the cache are looked up in the table with one query
+    stored = get_stored_panchang_data(key for key, date in pending.items() if date is not None)
+    for key, data in stored.items():
+        pending[key] = None
+        yield key, data
+
+    def fetch(location_id, date):
+        with app.app_context():
+            try:
+                return _fetch_panchang_data(location_id, date)
+            except Exception as e:
+                # One bad pair (e.g. a locked cache file) must not end the
+                # whole run; it is reported as a failure like an upstream error
+                app.logger.exception(f"Error fetching panchang for location {location_id}: {str(e)}")
+                return None
+
+    to_fetch = [(key, date) for key, date in pending.items() if date is not None]
+    if not to_fetch:
+        return
+
+    workers = min(app.config['PANCHANG_FETCH_WORKERS'], len(to_fetch))
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = {
+            executor.submit(fetch, key[0], date): key
+            for key, date in to_fetch
+        }
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        # When the consumer stops early (e.g. the client of a streamed batch
+        # went away), fetches that haven't started are dropped, not run
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def get_panchang_data_many(items):
+    """
+    Fetch panchang data for many (location_id, date) pairs concurrently
+
+    Args:
+        items (iterable): (location_id, date) pairs. A date of None means the current date.
+
+    Returns:
+        dict: Mapping of (location_id, 'YYYY-MM-DD') to panchang data, or None on failure
+    """
+    return dict(iter_panchang_data_many(items))
+
+@click.command('reparse-panchang')
+@with_appcontext
+def reparse_panchang_command():
+    """Reparse every stored panchang day from its raw payload
+
+    Run after changing the parser (and bumping PARSER_VERSION) so stored
+    fields match what it produces. Days are read in key order and committed
+    500 at a time, so memory stays at one batch; a day that fails to parse is
+    reported and left as it was. Other processes need no restart: caches are
+    keyed by the parser version, so processes running the new parser never
+    see entries made by the old one.
+    """
+    from app.models import db, PanchangDay
+
+    key = db.tuple_(PanchangDay.location_id, PanchangDay.date)
+    count = 0
+    failed = 0
+    last_key = None
+    while True:
+        query = PanchangDay.query.order_by(PanchangDay.location_id, PanchangDay.date)
+        if last_key is not None:
+            query = query.filter(key > db.tuple_(*last_key))
+        days = query.limit(500).all()
+        if not days:
+            break
+        last_key = (days[-1].location_id, days[-1].date)
+
+        for day in days:
+            try:
+                day.set_parsed(parse_panchang(day.raw_data))
+            except Exception as e:
+                click.echo(f"Could not reparse location {day.location_id} on {day.date}: {str(e)}", err=True)
+                failed += 1
+                continue
+            count += 1
+        db.session.commit()
+        # Committed days would otherwise stay in the session's identity map
+        db.session.expunge_all()
+    get_panchang_cache().clear()
+    click.echo(f"Reparsed {count} panchang days" + (f", {failed} failed" if failed else ""))
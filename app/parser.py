@@ -0,0 +1,185 @@
+import re
+from datetime import datetime
+from dataclasses import dataclass, field, asdict
+from html import unescape
+
+# Names used to tell the unlabelled "<name> till <time>" panchang elements
+# apart. Names are compared lowercased with spaces and punctuation removed.
+TITHIS = frozenset((
+    'pratipada', 'pratipat', 'prathama', 'dwitiya', 'dvitiya', 'tritiya',
+    'chaturthi', 'panchami', 'shashti', 'shashthi', 'saptami', 'ashtami',
+    'navami', 'dashami', 'ekadashi', 'dwadashi', 'dvadashi', 'trayodashi',
+    'chaturdashi', 'purnima', 'poornima', 'amavasya', 'amavasai',
+))
+NAKSHATRAS = frozenset((
+    'ashwini', 'bharani', 'krittika', 'kritika', 'rohini', 'mrigashira',
+    'mrigashirsha', 'ardra', 'arudra', 'punarvasu', 'pushya', 'pushyami',
+    'ashlesha', 'magha', 'purvaphalguni', 'poorvaphalguni', 'uttaraphalguni',
+    'hasta', 'chitra', 'chitta', 'swati', 'vishakha', 'anuradha', 'jyeshtha',
+    'jyeshta', 'mula', 'moola', 'purvashadha', 'poorvashadha', 'uttarashadha',
+    'shravana', 'sravana', 'dhanishta', 'dhanishtha', 'shatabhisha',
+    'shatabhishak', 'purvabhadrapada', 'poorvabhadra', 'purvabhadra',
+    'uttarabhadrapada', 'uttarabhadra', 'revati',
+))
+YOGAS = frozenset((
+    'vishkambha', 'preeti', 'priti', 'ayushman', 'saubhagya', 'shobhana',
+    'atiganda', 'sukarma', 'dhriti', 'shoola', 'shula', 'ganda', 'vriddhi',
+    'dhruva', 'vyaghata', 'harshana', 'vajra', 'siddhi', 'vyatipata',
+    'variyana', 'variyan', 'parigha', 'shiva', 'siddha', 'sadhya', 'shubha',
+    'shukla', 'brahma', 'indra', 'aindra', 'vaidhriti',
+))
+KARANAS = frozenset((
+    'bava', 'balava', 'kaulava', 'taitila', 'taitula', 'garaja', 'gara',
+    'vanija', 'vishti', 'bhadra', 'shakuni', 'chatushpada', 'naga', 'nagava',
+    'kimstughna', 'kintughna',
+))
+ELEMENTS = (
+    ('tithi', TITHIS),
+    ('nakshatra', NAKSHATRAS),
+    ('yoga', YOGAS),
+    ('karana', KARANAS),
+)
+_ALL_ELEMENT_NAMES = TITHIS | NAKSHATRAS | YOGAS | KARANAS
+
+# Dispatch table from a line's "<label>:" prefix (lowercased) to the field it fills
+LABELS = {
+    'tamil': 'tamil',
+    'rahukalam': 'rahukalam',
+    'yamagandam': 'yamagandam',
+    'gulikai': 'gulikai',
+    'abhijit': 'abhijit',
+    'durmuhurtham': 'durmuhurtham',
+    'varjyam': 'varjyam',
+    'amritkalam': 'amritkalam',
+    'sun': 'sun',
+    'moon': 'moon',
+    'sayana sun': 'sayana_sun',
+    'sun star': 'sun_star',
+    'dikshoolai': 'dikshoolai',
+    'kaal vaasa': 'kaal_vaasa',
+    'rahu vaasa': 'rahu_vaasa',
+    'agnivasa': 'agnivasa',
+    'moon abode': 'moon_abode',
+    'shraddha tithi': 'shraddha_tithi',
+}
+LIST_FIELDS = frozenset(('moon_abode',))
+HEADER_FIELDS = ('location', 'date', 'shaka', 'vikrami_north', 'vikrami_gujarat')
+
+_TAG_RE = re.compile(r'<[^>]*>')
+_LABEL_RE = re.compile(r'([A-Za-z][A-Za-z ]*?)\s*:')
+_NAME_RE = re.compile(r'[^a-z]')
+_TIME_RE = re.compile(r'(\d{1,2}:\d{2})\s*([AP]M)', re.IGNORECASE)
+
+# Bump whenever parse_panchang's output changes. Cached parses and
+# renderings are keyed by it, and stored days parsed by an older version are
+# parsed again when read, until reparse-panchang has updated them.
+PARSER_VERSION = 1
+
+@dataclass(slots=True)
+class PanchangData:
+    """Structured panchang for one location and date"""
+    location: str = ''
+    date: str = ''
+    shaka: str = ''
+    vikrami_north: str = ''
+    vikrami_gujarat: str = ''
+    sunrise_sunset: str = ''
+    moonrise_moonset: str = ''
+    tamil: str = ''
+    paksha: str = ''
+    tithi: list = field(default_factory=list)
+    nakshatra: list = field(default_factory=list)
+    yoga: list = field(default_factory=list)
+    karana: list = field(default_factory=list)
+    rahukalam: str = ''
+    yamagandam: str = ''
+    gulikai: str = ''
+    abhijit: str = ''
+    durmuhurtham: str = ''
+    varjyam: str = ''
+    amritkalam: str = ''
+    sun: str = ''
+    moon: str = ''
+    sayana_sun: str = ''
+    sun_star: str = ''
+    dikshoolai: str = ''
+    kaal_vaasa: str = ''
+    rahu_vaasa: str = ''
+    agnivasa: str = ''
+    moon_abode: list = field(default_factory=list)
+    shraddha_tithi: str = ''
+    # Lines that could not be attributed to any field
+    other: list = field(default_factory=list)
+
+    def to_dict(self):
+        return asdict(self)
+
+def _element_for(line, previous):
+    """Return which of tithi/nakshatra/yoga/karana an unlabelled line belongs to"""
+    name = _NAME_RE.sub('', line.split(' till', 1)[0].lower())
+    for element, names in ELEMENTS:
+        if name in names:
+            return element
+    # Unknown spelling: the feed lists the elements in order, so assume the
+    # one following the previous element
+    if previous is None:
+        return 'tithi'
+    index = next(i for i, (element, _) in enumerate(ELEMENTS) if element == previous)
+    return ELEMENTS[min(index + 1, len(ELEMENTS) - 1)][0]
+
+def parse_panchang(raw_data):
+    """Parse the raw panfeed HTML into a PanchangData in a single pass"""
+    text = unescape(_TAG_RE.sub('', raw_data))
+    result = PanchangData()
+    previous_element = None
+    header_index = 0
+
+    for line in text.split('\n'):
+        line = line.strip()
+        if not line:
+            continue
+
+        if header_index < len(HEADER_FIELDS):
+            setattr(result, HEADER_FIELDS[header_index], line)
+            header_index += 1
+            continue
+
+        match = _LABEL_RE.match(line)
+        if match:
+            name = LABELS.get(match.group(1).lower())
+            if name in LIST_FIELDS:
+                getattr(result, name).append(line)
+            elif name is not None:
+                setattr(result, name, line)
+            else:
+                result.other.append(line)
+        elif '🔆' in line:
+            result.sunrise_sunset = line.replace('🔆', '').strip()
+        elif '🌙' in line:
+            result.moonrise_moonset = line.replace('🌙', '').strip()
+        elif 'Paksha' in line:
+            result.paksha = line
+        elif 'till' in line or _NAME_RE.sub('', line.lower()) in _ALL_ELEMENT_NAMES:
+            previous_element = _element_for(line, previous_element)
+            getattr(result, previous_element).append(line)
+        else:
+            result.other.append(line)
+
+    return result
+
+def parse_time_range(text):
+    """Return the first two times in a line like "Rahukalam: 09:26 AM till 10:53 AM"
+
+    Returns:
+        tuple: (start, end) as datetime.time, None for any that is missing or
+            not a valid time (e.g. "00:10 AM")
+    """
+    times = [_parse_time(clock, meridiem) for clock, meridiem in _TIME_RE.findall(text)[:2]]
+    times += [None] * (2 - len(times))
+    return tuple(times)
+
+def _parse_time(clock, meridiem):
+    try:
+        return datetime.strptime(f"{clock} {meridiem.upper()}", '%I:%M %p').time()
+    except ValueError:
+        return None
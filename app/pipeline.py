@@ -0,0 +1,216 @@
+"""Staged delivery pipeline: fetch -> render -> send
+
+Each stage runs on its own pool of threads and hands work to the next over
+a bounded queue. Panchang lookups, rendering and SMTP therefore overlap,
+and a slow stage makes the stages before it block (backpressure) instead
+of piling up work in memory. Upstream fetches are left to the caller, which
+makes one per panchang a batch of work needs.
+"""
+import queue
+import threading
+from flask import current_app
+from app import db, metrics
+
+_STOP = object()
+
+class DeliveryPipeline:
+    """Sends each recipient one panchang email per date, with a card per city
+
+    Work is submitted with ``submit`` (which blocks while the pipeline is
+    full) and per-message outcomes are collected with ``drain``, once
+    more after ``close`` for the last ones. Stage threads run in their own
+    app context and only read the panchang cache and table; recording
+    outcomes is left to the caller. ``emails_sent`` and ``emails_failed``
+    count emails, each of which may carry several messages.
+    """
+
+    def __init__(self, app, fetch_workers, render_workers, send_workers, queue_size):
+        self.app = app
+        self.workers = (fetch_workers, render_workers, send_workers)
+        self._fetch_queue = queue.Queue(queue_size)
+        self._render_queue = queue.Queue(queue_size)
+        self._send_queue = queue.Queue(queue_size)
+        # Outcomes are tiny and drained by the producer, so this one is unbounded
+        self._results = queue.SimpleQueue()
+        self._stages = []
+        self._counts_lock = threading.Lock()
+        self.emails_sent = 0
+        self.emails_failed = 0
+
+    @classmethod
+    def from_config(cls, app):
+        config = app.config
+        return cls(
+            app,
+            config['PIPELINE_FETCH_WORKERS'],
+            config['PIPELINE_RENDER_WORKERS'],
+            config['PIPELINE_SEND_WORKERS'],
+            config['PIPELINE_QUEUE_SIZE']
+        )
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self):
+        stages = (
+            (self._fetch_queue, self._fetch),
+            (self._render_queue, self._render),
+            (self._send_queue, self._send),
+        )
+        for (inbox, handle), count in zip(stages, self.workers):
+            threads = [
+                threading.Thread(target=self._run, args=(inbox, handle), daemon=True)
+                for _ in range(count)
+            ]
+            for thread in threads:
+                thread.start()
+            self._stages.append((inbox, threads))
+
+    def submit(self, email, date, messages):
+        """Queue a recipient's message rows (with id, location_id and city_name) for one date
+        
+        The messages are coalesced into a single email, whose outcome is
+        reported for each of them.
+        """
+        self._fetch_queue.put((email, date, messages))
+
+    def drain(self):
+        """Return the (id, error) outcomes completed since the last call
+        
+        The error is None if the message was sent and OutboxMessage.DEFERRED
+        if its panchang isn't available yet.
+        """
+        results = []
+        while True:
+            try:
+                results.append(self._results.get_nowait())
+            except queue.Empty:
+                return results
+
+    def close(self):
+        """Finish all submitted work and stop the stages"""
+        # Stop the stages in order so each one drains into the next
+        for inbox, threads in self._stages:
+            for _ in threads:
+                inbox.put(_STOP)
+            for thread in threads:
+                thread.join()
+        self._stages = []
+
+    def _run(self, inbox, handle):
+        with self.app.app_context():
+            state = {}
+            try:
+                while True:
+                    item = inbox.get()
+                    if item is _STOP:
+                        break
+                    try:
+                        handle(item, state)
+                    except Exception as e:
+                        # Outcomes of the item are never reported; its
+                        # messages are retried once their claim expires
+                        current_app.logger.error(f"Delivery pipeline stage failed: {str(e)}")
+                    finally:
+                        # Return the pooled connection between items, so
+                        # idle stage threads don't starve the job thread
+                        db.session.remove()
+            finally:
+                sender = state.get('sender')
+                if sender is not None:
+                    sender.close()
+
+    def _count_email(self, sent):
+        with self._counts_lock:
+            if sent:
+                self.emails_sent += 1
+            else:
+                self.emails_failed += 1
+
+    def _fail(self, messages, error):
+        for message in messages:
+            self._results.put((message.id, error))
+
+    def _fetch(self, item, state):
+        from app.models import OutboxMessage
+        from app.panchang import get_cached_panchang_data
+
+        email, date, messages = item
+        # The caller fetches what a batch needs from upstream before
+        # submitting it; misses here failed that fetch or, without
+        # PANCHANG_DELIVERY_FETCH_ON_MISS, wait for the next prefetch
+        found = {}
+        for location_id in {message.location_id for message in messages}:
+            try:
+                found[location_id] = get_cached_panchang_data(location_id, date)
+            except Exception as e:
+                current_app.logger.error(f"Error loading panchang for location {location_id}: {str(e)}")
+
+        # One card per (location, city); subscriptions repeating one share it
+        cities = {}
+        for message in messages:
+            panchang_data = found.get(message.location_id)
+            if not panchang_data and not current_app.config['PANCHANG_DELIVERY_FETCH_ON_MISS']:
+                # Not a failed attempt: the message waits for the prefetch
+                # job, for up to OUTBOX_DEFER_MAX_DAYS after its date
+                current_app.logger.info(f"No panchang yet for location {message.location_id} on {date}, deferring")
+                self._fail([message], OutboxMessage.DEFERRED)
+                continue
+            if not panchang_data:
+                # The other cities go out now; this one is retried on its own
+                current_app.logger.error(f"No panchang data for location {message.location_id} on {date}")
+                self._fail([message], 'No panchang data')
+                continue
+            key = (message.location_id, message.city_name)
+            cities.setdefault(key, (message.city_name, panchang_data, []))[2].append(message)
+        if cities:
+            self._render_queue.put((email, list(cities.values())))
+        elif current_app.config['PANCHANG_DELIVERY_FETCH_ON_MISS']:
+            # Every city failed, so the recipient's email did too (without
+            # the flag they were all deferred)
+            self._count_email(False)
+
+    def _render(self, item, state):
+        from app.email_service import build_digest_message
+
+        email, cities = item
+        messages = [message for _, _, city_messages in cities for message in city_messages]
+        try:
+            # Each city's card is rendered once per (location, city, date) and shared
+            msg = build_digest_message(
+                email,
+                [(city_name, panchang_data) for city_name, panchang_data, _ in cities]
+            )
+        except Exception as e:
+            current_app.logger.error(f"Error processing messages for {email}: {str(e)}")
+            self._count_email(False)
+            self._fail(messages, str(e))
+            return
+        self._send_queue.put((messages, msg))
+
+    def _send(self, item, state):
+        from app.email_service import SMTPSender
+
+        # Each send worker keeps its own SMTP connection across items
+        sender = state.get('sender')
+        if sender is None:
+            sender = state['sender'] = SMTPSender()
+        messages, msg = item
+        try:
+            sent = sender.send(msg)
+        except Exception as e:
+            # Flask-Mail rejects some messages before they reach the server
+            # (no sender, bad headers); they fail like a refused send
+            current_app.logger.error(f"Error sending email to {msg.recipients}: {str(e)}")
+            metrics.emails_failed_total.inc()
+            sender.close()
+            self._count_email(False)
+            self._fail(messages, str(e))
+            return
+        self._count_email(sent)
+        for message in messages:
+            self._results.put((message.id, None if sent else sender.last_error))
@@ -1,13 +1,31 @@
-from flask import Blueprint, jsonify, request, current_app
+from flask import Blueprint, jsonify, request, current_app, g, Response, stream_with_context
 from flask_login import login_required, current_user
-from app.models import db, Subscription, User
-from app.panchang import get_panchang_data
+from app.models import db, OutboxMessage, Subscription, User
+from app.panchang import get_panchang_data, iter_panchang_data_many
+from app.cache import get_panchang_cache
+from app.http_caching import cached_json_response
+from app.locations import search_locations
+from app.upstream import upstream_status
+from app.metrics import registry
 from app.auth import token_required
-from datetime import datetime
+from app.subscriptions import (
+    import_subscriptions, iter_subscription_export, read_import_rows, validate_subscription
+)
+from datetime import datetime, timedelta
+from sqlalchemy.exc import SQLAlchemyError
+import csv
+import json
 import requests
 
 main = Blueprint('main', __name__)
 
+# Content types accepted by /api/subscriptions/import
+SUBSCRIPTION_FORMATS = {
+    'text/csv': 'csv',
+    'application/x-ndjson': 'jsonl',
+    'application/jsonl': 'jsonl',
+}
+
 @main.route('/')
 def index():
     return jsonify({'message': 'Welcome to Panchang API'})
@@ -15,52 +33,137 @@ def index():
 @main.route('/api/panchang')
 def get_panchang():
     """Get panchang data for a specific location and date"""
+    location_id, date, error = panchang_args()
+    if error is not None:
+        return error
+    
+    return panchang_response(location_id, date, get_panchang_data(location_id, date))
+
+def panchang_args():
+    """Read /api/panchang's query string
+    
+    Returns:
+        tuple: location_id, date (None for today) and an error response, if any
+    """
     location_id = request.args.get('location_id')
     date_str = request.args.get('date')
     
     if not location_id:
-        return jsonify({'error': 'location_id is required'}), 400
+        return None, None, (jsonify({'error': 'location_id is required'}), 400)
     
     try:
-        if date_str:
-            date = datetime.strptime(date_str, '%Y-%m-%d')
-        else:
-            date = None
-            
-        data = get_panchang_data(location_id, date)
-        if data is None:
-            return jsonify({'error': 'Failed to fetch panchang data'}), 500
-            
-        return jsonify(data)
-        
+        date = datetime.strptime(date_str, '%Y-%m-%d') if date_str else None
     except ValueError:
+        return None, None, (jsonify({'error': 'Invalid date format. Use YYYY-MM-DD'}), 400)
+    return location_id, date, None
+
+def panchang_response(location_id, date, data):
+    """Build /api/panchang's response for the data fetched for ``location_id`` and ``date``"""
+    if data is None:
+        return jsonify({'error': 'Failed to fetch panchang data'}), 500
+    
+    # A given day's panchang never changes; only "today" moves
+    is_today = date is None or date.date() == datetime.now().date()
+    if is_today:
+        max_age = current_app.config['PANCHANG_HTTP_TODAY_MAX_AGE']
+    else:
+        max_age = current_app.config['PANCHANG_HTTP_MAX_AGE']
+    return cached_json_response(
+        data, f"{location_id}:{data['date']}", max_age, immutable=not is_today
+    )
+
+@main.route('/api/panchang/batch', methods=['GET', 'POST'])
+def get_panchang_batch():
+    """Get panchang data for several locations over a date range
+    
+    Takes ``location_id`` (comma separated, or a list in a JSON body),
+    ``start`` and optional ``end`` (inclusive, YYYY-MM-DD). Results are
+    fetched concurrently and streamed as JSON Lines in completion order,
+    one object per (location_id, date). Requests with a valid X-API-Token
+    may ask for PANCHANG_BATCH_MAX_ITEMS pairs, others for
+    PANCHANG_BATCH_ANONYMOUS_MAX_ITEMS.
+    """
+    token = request.headers.get('X-API-Token')
+    if token and not User.verify_api_token(token):
+        return jsonify({'error': 'Invalid API token'}), 401
+    
+    if request.method == 'POST':
+        params = request.get_json(silent=True) or {}
+        if not isinstance(params, dict):
+            return jsonify({'error': 'Expected a JSON object'}), 400
+    else:
+        params = request.args
+    location_ids = params.get('location_id') or []
+    if isinstance(location_ids, str):
+        location_ids = [location_id.strip() for location_id in location_ids.split(',')]
+    elif not isinstance(location_ids, list) or not all(isinstance(location_id, str) for location_id in location_ids):
+        return jsonify({'error': 'location_id must be a string or a list of strings'}), 400
+    location_ids = list(dict.fromkeys(location_id for location_id in location_ids if location_id))
+    
+    if not location_ids or not params.get('start'):
+        return jsonify({'error': 'location_id and start are required'}), 400
+    
+    try:
+        start = datetime.strptime(params['start'], '%Y-%m-%d').date()
+        end = datetime.strptime(params['end'], '%Y-%m-%d').date() if params.get('end') else start
+    except (TypeError, ValueError):
         return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD'}), 400
+    
+    if end < start:
+        return jsonify({'error': 'end must not be before start'}), 400
+    
+    days = (end - start).days + 1
+    max_items = current_app.config['PANCHANG_BATCH_MAX_ITEMS' if token else 'PANCHANG_BATCH_ANONYMOUS_MAX_ITEMS']
+    if days * len(location_ids) > max_items:
+        return jsonify({'error': f"At most {max_items} location/date pairs per request"}), 400
+    
+    items = [
+        (location_id, start + timedelta(days=offset))
+        for location_id in location_ids
+        for offset in range(days)
+    ]
+    
+    def generate():
+        for (location_id, date), data in iter_panchang_data_many(items):
+            if data is None:
+                line = {'location_id': location_id, 'date': date, 'error': 'Failed to fetch panchang data'}
+            else:
+                line = {'location_id': location_id, 'date': date, 'data': data}
+            yield json.dumps(line) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@main.route('/api/panchang/cache')
+def get_panchang_cache_stats():
+    """Get hit/miss/eviction counters for the panchang cache tiers"""
+    return jsonify(get_panchang_cache().stats())
+
+@main.route('/api/upstream/status')
+def get_upstream_status():
+    """Get circuit breaker and rate limiter state for upstream hosts"""
+    return jsonify(upstream_status())
+
+@main.route('/metrics')
+def get_metrics():
+    """Expose metrics in the Prometheus text format"""
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
 
 @main.route('/api/subscribe', methods=['POST'])
 @token_required
 def subscribe():
     """Subscribe to daily panchang emails for a location"""
-    data = request.get_json()
-    location_id = data.get('location_id')
-    city_name = data.get('city_name')
-    email = data.get('email')
+    values, error = validate_subscription(request.get_json() or {})
+    if error:
+        return jsonify({'error': error}), 400
     
-    if not location_id or not city_name or not email:
-        return jsonify({'error': 'location_id, city_name, and email are required'}), 400
-    
-    # Basic email validation
-    if '@' not in email or '.' not in email:
-        return jsonify({'error': 'Invalid email format'}), 400
-    
-    # Get user from token
-    token = request.headers.get('X-API-Token')
-    user = User.verify_api_token(token)
+    # Get user verified by token_required
+    user = g.api_user
     
     # Check if subscription already exists
     existing_sub = Subscription.query.filter_by(
         user_id=user.id,
-        location_id=location_id,
-        email=email,
+        location_id=values['location_id'],
+        email=values['email'],
         is_active=True
     ).first()
     
@@ -68,12 +171,7 @@ def subscribe():
         return jsonify({'message': 'Already subscribed to this location with this email'}), 400
     
     # Create new subscription
-    subscription = Subscription(
-        user_id=user.id,
-        location_id=location_id,
-        city_name=city_name,
-        email=email
-    )
+    subscription = Subscription(user_id=user.id, **values)
     
     db.session.add(subscription)
     db.session.commit()
@@ -87,8 +185,7 @@ def subscribe():
 @token_required
 def get_subscriptions():
     """Get user's active subscriptions"""
-    token = request.headers.get('X-API-Token')
-    user = User.verify_api_token(token)
+    user = g.api_user
     
     subscriptions = Subscription.query.filter_by(
         user_id=user.id,
@@ -100,15 +197,59 @@ def get_subscriptions():
         'location_id': sub.location_id,
         'city_name': sub.city_name,
         'email': sub.email,
+        'timezone': sub.timezone,
+        'delivery_time': sub.delivery_time.strftime('%H:%M'),
         'created_at': sub.created_at.isoformat()
     } for sub in subscriptions])
 
+@main.route('/api/subscriptions/import', methods=['POST'])
+@token_required
+def import_subscriptions_file():
+    """Create many subscriptions from an uploaded CSV or JSON Lines file
+    
+    The format is taken from ``format`` (csv or jsonl) or the Content-Type.
+    CSV files need a header line naming the fields /api/subscribe takes.
+    Invalid and duplicate rows are skipped and reported; the rest are
+    imported in one transaction.
+    """
+    fmt = request.args.get('format') or SUBSCRIPTION_FORMATS.get(request.mimetype)
+    if fmt not in ('csv', 'jsonl'):
+        return jsonify({'error': 'Send text/csv or application/x-ndjson, or set format to csv or jsonl'}), 415
+    
+    try:
+        result = import_subscriptions(g.api_user.id, read_import_rows(request.stream, fmt))
+    except UnicodeDecodeError:
+        return jsonify({'error': 'File must be UTF-8 encoded'}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except csv.Error as e:
+        return jsonify({'error': f"Invalid CSV: {str(e)}"}), 400
+    except SQLAlchemyError as e:
+        current_app.logger.error(f"Error importing subscriptions: {str(e)}")
+        return jsonify({'error': 'Failed to import subscriptions'}), 500
+    
+    return jsonify(result)
+
+@main.route('/api/subscriptions/export', methods=['GET'])
+@token_required
+def export_subscriptions():
+    """Stream the user's active subscriptions as CSV (default) or JSON Lines"""
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'jsonl'):
+        return jsonify({'error': 'format must be csv or jsonl'}), 400
+    
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    response = Response(
+        stream_with_context(iter_subscription_export(g.api_user.id, fmt)), mimetype=mimetype
+    )
+    response.headers['Content-Disposition'] = f'attachment; filename=subscriptions.{fmt}'
+    return response
+
 @main.route('/api/subscriptions/<int:subscription_id>', methods=['DELETE'])
 @token_required
 def unsubscribe(subscription_id):
     """Unsubscribe from daily panchang emails"""
-    token = request.headers.get('X-API-Token')
-    user = User.verify_api_token(token)
+    user = g.api_user
     
     subscription = Subscription.query.filter_by(
         id=subscription_id,
@@ -116,6 +257,8 @@ def unsubscribe(subscription_id):
     ).first_or_404()
     
     subscription.is_active = False
+    # Emails already queued for it must not go out either
+    OutboxMessage.cancel_for_subscription(subscription.id)
     db.session.commit()
     
     return jsonify({'message': 'Successfully unsubscribed'})
@@ -128,22 +271,8 @@ def get_location_id():
         return jsonify({'error': 'city parameter is required'}), 400
         
     try:
-        response = requests.get(
-            'https://mypanchang.com/newsite/placequery.php',
-            params={'place': city}
-        )
-        response.raise_for_status()
-        
-        # Handle empty response
-        if not response.text.strip():
-            return jsonify([]), 200
-            
-        try:
-            return jsonify(response.json())
-        except ValueError:
-            # If JSON parsing fails, return empty list
-            return jsonify([]), 200
+        return jsonify(search_locations(city))
             
     except requests.RequestException as e:
         current_app.logger.error(f"Error fetching location data: {str(e)}")
-        return jsonify({'error': 'Failed to fetch location data'}), 500 
\ No newline at end of file
+        return jsonify({'error': 'Failed to fetch location data'}), 500
\ No newline at end of file
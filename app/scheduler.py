@@ -1,57 +1,356 @@
 from flask_apscheduler import APScheduler
-from datetime import datetime
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from flask import current_app
+from app import metrics
+from app.metrics import RunStats
+import os
+import secrets
+import socket
+import time
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 scheduler = APScheduler()
 
-def send_daily_panchang_emails():
-    """Send daily panchang emails to all active subscribers"""
-    from app.models import Subscription
-    from app.panchang import get_panchang_data
-    from app.email_service import send_panchang_email
+LOCK_OWNER = f"{socket.gethostname()}:{os.getpid()}"
+
+@contextmanager
+def job_lock(name):
+    """Hold the database lease for job ``name``; yields False if another process has it"""
+    from app.models import db, JobLock
+    
+    acquired = JobLock.acquire(name, LOCK_OWNER, current_app.config['SCHEDULER_LOCK_TTL'])
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            # Discard anything a failed job left uncommitted before releasing
+            db.session.rollback()
+            JobLock.release(name, LOCK_OWNER)
+
+def renew_job_lock(name):
+    """Extend the lease on ``name`` held through ``job_lock``; return False if it was lost
+    
+    Jobs that may outlast SCHEDULER_LOCK_TTL call this between batches.
+    """
+    from app.models import JobLock
     
+    return JobLock.acquire(name, LOCK_OWNER, current_app.config['SCHEDULER_LOCK_TTL'])
+
+def send_daily_panchang_emails():
+    """Queue today's email for every due subscription, then deliver the outbox"""
+    with scheduler.app.app_context():
+        with job_lock('send_daily_panchang') as acquired:
+            if acquired:
+                _enqueue_daily_panchang_emails()
+            else:
+                current_app.logger.info("send_daily_panchang is running in another process, skipping")
+        _run_delivery()
+
+def deliver_outbox():
+    """Deliver queued emails that are due, including retries of failed ones"""
     with scheduler.app.app_context():
-        # Get all active subscriptions
-        subscriptions = Subscription.query.filter_by(is_active=True).all()
+        _run_delivery()
+
+def _run_delivery():
+    # Claims keep workers apart, so this needs no job lock
+    stats = RunStats('deliver_outbox')
+    _deliver_outbox(stats)
+    stats.finish()
+    if stats.sent or stats.failed or stats.deferred:
+        current_app.logger.info(stats.summary())
+
+def start_of_local_day(now=None):
+    """Return the UTC time (naive, like last_sent) of the most recent local midnight
+    
+    ``now`` may be naive (server local time) or carry a time zone.
+    """
+    now = now or datetime.now()
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    return midnight.astimezone(timezone.utc).replace(tzinfo=None)
+
+def _enqueue_daily_panchang_emails():
+    """Queue today's email for every subscription that is due and hasn't had it yet
+    
+    Callers must hold the send_daily_panchang lock. The job runs at the start
+    of every delivery slot and handles each subscriber time zone in turn:
+    subscriptions whose local delivery time has passed (including earlier,
+    missed slots) and that weren't queued on the local date get an outbox
+    message for that local date. Within a time zone they are read in id
+    order, in chunks of SCHEDULER_BATCH_SIZE, and each chunk's messages and
+    last_sent are committed together, so nothing is queued twice.
+    
+    A recipient's other subscriptions in the same time zone are queued with
+    their first due one, so they share one email at the earliest delivery
+    time. Subscriptions of one address in different time zones are queued
+    separately, at their own delivery times; delivery still coalesces any of
+    them that wait for the same local date in the same claim.
+    """
+    from app.models import db, Subscription
+    
+    _purge_outbox()
+    now = datetime.now(timezone.utc)
+    timezones = [
+        tz_name for (tz_name,) in db.session.query(Subscription.timezone)
+        .filter(Subscription.is_active.is_(True)).distinct()
+    ]
+    
+    queued = 0
+    for tz_name in timezones:
+        if not renew_job_lock('send_daily_panchang'):
+            current_app.logger.warning("Lost the send_daily_panchang lock, stopping this run")
+            break
+        try:
+            local_now = now.astimezone(ZoneInfo(tz_name))
+        except (ZoneInfoNotFoundError, ValueError):
+            current_app.logger.error(f"Skipping subscriptions with unknown time zone {tz_name!r}")
+            continue
+        queued += _enqueue_due_in_timezone(tz_name, local_now)
+    if queued:
+        current_app.logger.info(f"Queued {queued} panchang emails")
+
+def _enqueue_due_in_timezone(tz_name, local_now):
+    """Queue emails for subscriptions in ``tz_name`` due by ``local_now``; return how many"""
+    from app.models import db, OutboxMessage, Subscription
+    
+    day_start = start_of_local_day(local_now)
+    batch_size = current_app.config['SCHEDULER_BATCH_SIZE']
+    
+    queued = 0
+    last_id = 0
+    while True:
+        # Keyset pagination over plain column rows keeps memory at one batch;
+        # no ORM instances accumulate in the session
+        subscriptions = db.session.query(
+            Subscription.id,
+            Subscription.location_id,
+            Subscription.city_name,
+            Subscription.email
+        ).filter(
+            Subscription.is_active.is_(True),
+            Subscription.timezone == tz_name,
+            Subscription.delivery_time <= local_now.time().replace(tzinfo=None),
+            db.or_(Subscription.last_sent.is_(None), Subscription.last_sent < day_start),
+            Subscription.id > last_id
+        ).order_by(Subscription.id).limit(batch_size).all()
+        if not subscriptions:
+            break
+        last_id = subscriptions[-1].id
+        
+        # Bring the same recipients' later subscriptions forward, so all of
+        # their cities go out in one email
+        subscriptions += db.session.query(
+            Subscription.id,
+            Subscription.location_id,
+            Subscription.city_name,
+            Subscription.email
+        ).filter(
+            Subscription.is_active.is_(True),
+            Subscription.timezone == tz_name,
+            db.or_(Subscription.last_sent.is_(None), Subscription.last_sent < day_start),
+            Subscription.email.in_({subscription.email for subscription in subscriptions}),
+            Subscription.id.notin_([subscription.id for subscription in subscriptions])
+        ).all()
         
-        for subscription in subscriptions:
-            try:
-                # Get panchang data
-                panchang_data = get_panchang_data(subscription.location_id)
-                if not panchang_data:
-                    current_app.logger.error(
-                        f"Failed to fetch panchang data for location {subscription.location_id}"
-                    )
-                    continue
-                
-                # Send email to subscription email
-                success = send_panchang_email(
-                    subscription.email,
-                    subscription.city_name,
-                    panchang_data
-                )
-                
-                if success:
-                    # Update last_sent timestamp
-                    subscription.last_sent = datetime.utcnow()
-                    scheduler.app.db.session.commit()
-                
-            except Exception as e:
-                current_app.logger.error(
-                    f"Error processing subscription {subscription.id}: {str(e)}"
-                )
-                continue
+        db.session.bulk_insert_mappings(OutboxMessage, [
+            {
+                'subscription_id': subscription.id,
+                'location_id': subscription.location_id,
+                'city_name': subscription.city_name,
+                'email': subscription.email,
+                'local_date': local_now.date()
+            }
+            for subscription in subscriptions
+        ])
+        # last_sent marks the day as handled; the outbox tracks delivery
+        Subscription.query.filter(
+            Subscription.id.in_([subscription.id for subscription in subscriptions])
+        ).update({'last_sent': datetime.utcnow()}, synchronize_session=False)
+        with metrics.db_commit_seconds.time():
+            db.session.commit()
+        
+        queued += len(subscriptions)
+        if not renew_job_lock('send_daily_panchang'):
+            # The rest is queued by whoever took the lock over
+            break
+    return queued
+
+def _purge_outbox():
+    """Delete sent messages older than OUTBOX_RETENTION_DAYS"""
+    from app.models import db, OutboxMessage
+    
+    cutoff = datetime.utcnow() - timedelta(days=current_app.config['OUTBOX_RETENTION_DAYS'])
+    OutboxMessage.query.filter(
+        OutboxMessage.status == OutboxMessage.SENT,
+        OutboxMessage.sent_at < cutoff
+    ).delete(synchronize_session=False)
+    db.session.commit()
+
+def _deliver_outbox(stats):
+    """Claim due outbox messages in batches and send them through the delivery pipeline
+    
+    A recipient's messages for a day are claimed together and coalesced into
+    one email with a card per city. Outcomes are recorded after each claimed
+    batch: sent messages are done, failed ones are scheduled for a retry with
+    exponential backoff or, once out of attempts, marked dead.
+    
+    Messages still in flight have their claim renewed after the upstream
+    fetch and while submitting, so a long batch doesn't lose them to
+    another worker.
+    """
+    from app.models import OutboxMessage
+    from app.panchang import get_panchang_data_many
+    from app.pipeline import DeliveryPipeline
+    
+    config = current_app.config
+    token = secrets.token_hex(16)
+    ttl = config['OUTBOX_CLAIM_TTL']
+    renewed_at = time.monotonic()
+    
+    def renew_claim():
+        # Renewed once a third of the TTL has passed, well before it lapses
+        nonlocal renewed_at
+        if time.monotonic() - renewed_at >= ttl / 3:
+            OutboxMessage.renew(token, ttl)
+            renewed_at = time.monotonic()
+    
+    pipeline = DeliveryPipeline.from_config(current_app._get_current_object())
+    with pipeline:
+        while True:
+            renew_claim()
+            messages = OutboxMessage.claim(token, config['SCHEDULER_BATCH_SIZE'], ttl)
+            if not messages:
+                break
+            renewed_at = time.monotonic()
+            
+            if config['PANCHANG_DELIVERY_FETCH_ON_MISS']:
+                # Each panchang the batch needs is fetched once here, so the
+                # pipeline's per-recipient lookups only read the cache
+                get_panchang_data_many({
+                    (message.location_id, message.local_date) for message in messages
+                })
+                renew_claim()
+            
+            # One email per recipient and day, whatever number of cities
+            # they subscribed to
+            messages_by_recipient = defaultdict(list)
+            for message in messages:
+                messages_by_recipient[(message.email, message.local_date)].append(message)
+            for (email, local_date), recipient_messages in messages_by_recipient.items():
+                # Blocks while the pipeline is full
+                pipeline.submit(email, local_date, recipient_messages)
+                renew_claim()
+            
+            _record_results(token, pipeline.drain(), stats)
+    _record_results(token, pipeline.drain(), stats)
+    stats.sent = pipeline.emails_sent
+    stats.failed = pipeline.emails_failed
+
+def _record_results(token, results, stats):
+    """Count deferred messages and store pipeline outcomes on the outbox messages"""
+    from app.models import OutboxMessage
+    
+    if not results:
+        return
+    # Sent and failed are counted per email by the pipeline
+    stats.deferred += sum(1 for _, error in results if error is OutboxMessage.DEFERRED)
+    with metrics.db_commit_seconds.time():
+        lost = OutboxMessage.record(
+            token,
+            results,
+            current_app.config['OUTBOX_MAX_ATTEMPTS'],
+            current_app.config['OUTBOX_RETRY_BACKOFF'],
+            current_app.config['OUTBOX_DEFER_MAX_DAYS']
+        )
+    if lost:
+        # Another worker claimed them after our claim lapsed and may send
+        # them again, or they were cancelled by an unsubscribe
+        current_app.logger.warning(
+            f"Could not record {lost} delivery outcomes, their claim was taken over or cancelled"
+        )
+
+def prefetch_panchang():
+    """Fetch and store the panchang every subscribed location will need next"""
+    with scheduler.app.app_context(), job_lock('prefetch_panchang') as acquired:
+        if not acquired:
+            current_app.logger.info("prefetch_panchang is running in another process, skipping")
+            return
+        with metrics.job_run_seconds.time(job='prefetch_panchang'):
+            _prefetch_panchang()
+
+def _prefetch_panchang():
+    """Fill the panchang cache for today and tomorrow in each subscriber's time zone
+    
+    The delivery job then reads from the durable cache instead of going
+    upstream. Days that queued messages are still waiting for are fetched
+    too, so a message deferred past its date is sent once upstream answers,
+    unless OUTBOX_DEFER_MAX_DAYS have passed by then. Already cached days are skipped, so every run only
+    retries what earlier runs failed to fetch.
+    """
+    from app.models import db, OutboxMessage, Subscription
+    from app.panchang import get_panchang_data_many
+    
+    now = datetime.now(timezone.utc)
+    items = set()
+    pairs = db.session.query(Subscription.location_id, Subscription.timezone).filter(
+        Subscription.is_active.is_(True)
+    ).distinct()
+    for location_id, tz_name in pairs:
+        try:
+            local_today = now.astimezone(ZoneInfo(tz_name)).date()
+        except (ZoneInfoNotFoundError, ValueError):
+            continue
+        items.add((location_id, local_today))
+        items.add((location_id, local_today + timedelta(days=1)))
+    waiting = db.session.query(OutboxMessage.location_id, OutboxMessage.local_date).filter(
+        OutboxMessage.status.in_((OutboxMessage.PENDING, OutboxMessage.FAILED))
+    ).distinct()
+    items.update((location_id, local_date) for location_id, local_date in waiting)
+    
+    # In batches, renewing the lease in between, so a long run keeps it
+    items = list(items)
+    batch_size = current_app.config['SCHEDULER_BATCH_SIZE']
+    results = {}
+    for offset in range(0, len(items), batch_size):
+        if offset and not renew_job_lock('prefetch_panchang'):
+            current_app.logger.warning("Lost the prefetch_panchang lock, stopping this run")
+            break
+        results.update(get_panchang_data_many(items[offset:offset + batch_size]))
+    failed = sorted(key for key, data in results.items() if data is None)
+    current_app.logger.info(
+        f"Prefetched panchang for {len(results) - len(failed)} of {len(results)} location days"
+    )
+    if failed:
+        current_app.logger.warning(f"Prefetch failed for {failed}, will retry on the next run")
 
 def init_scheduler(app):
     """Initialize the scheduler with the Flask app"""
     scheduler.init_app(app)
     
-    # Add job to send emails every minute (for testing)
+    # Prefetch ahead of delivery, retrying anything missing on each run
+    scheduler.add_job(
+        id='prefetch_panchang',
+        func=prefetch_panchang,
+        trigger='interval',
+        minutes=app.config['PANCHANG_PREFETCH_INTERVAL_MINUTES']
+    )
+    
+    # Run at the start of every delivery slot; each run only sends to the
+    # subscriptions that became due, spreading load across the day
     scheduler.add_job(
         id='send_daily_panchang',
         func=send_daily_panchang_emails,
+        trigger='cron',
+        minute=f"*/{app.config['SCHEDULER_SLOT_MINUTES']}"
+    )
+    
+    # Pick up retries between slots
+    scheduler.add_job(
+        id='deliver_outbox',
+        func=deliver_outbox,
         trigger='interval',
-        minutes=1
+        seconds=app.config['OUTBOX_POLL_INTERVAL_SECONDS']
     )
     
     scheduler.start() 
\ No newline at end of file
@@ -0,0 +1,223 @@
+"""Subscription validation, bulk import and streaming export"""
+import codecs
+import csv
+import io
+import json
+import re
+from datetime import time
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from flask import current_app
+from app.models import db, Subscription
+
+# Columns of an export, in order
+EXPORT_FIELDS = ('id', 'location_id', 'city_name', 'email', 'timezone', 'delivery_time', 'created_at')
+
+CONTROL_CHARACTERS = re.compile(r'[\x00-\x1f\x7f]')
+
+# Invalid import rows reported back in detail; the rest are only counted
+MAX_REPORTED_ERRORS = 100
+
+def slot_start(value, slot_minutes):
+    """Round a time of day down to the start of its delivery slot"""
+    minute = value.minute - value.minute % slot_minutes
+    return value.replace(minute=minute, second=0, microsecond=0)
+
+def validate_subscription(data):
+    """
+    Check a subscription's fields and fill in defaults
+
+    Args:
+        data (dict): location_id, city_name, email and optional timezone
+            and delivery_time (HH:MM)
+
+    Returns:
+        tuple: (column values for a Subscription, None), or (None, error message)
+    """
+    location_id = data.get('location_id')
+    if isinstance(location_id, int) and not isinstance(location_id, bool):
+        location_id = str(location_id)
+    city_name = data.get('city_name')
+    email = data.get('email')
+
+    if not all(isinstance(value, str) and value.strip() for value in (location_id, city_name, email)):
+        return None, 'location_id, city_name, and email are required'
+    location_id, city_name, email = location_id.strip(), city_name.strip(), email.strip()
+
+    # Checked here, as one overlong row fails a whole bulk insert on
+    # databases that enforce column lengths
+    for name, value in (('location_id', location_id), ('city_name', city_name), ('email', email)):
+        max_length = Subscription.__table__.c[name].type.length
+        if len(value) > max_length:
+            return None, f"{name} must be at most {max_length} characters"
+        # These end up in email headers and subjects
+        if CONTROL_CHARACTERS.search(value):
+            return None, f"{name} must not contain control characters"
+
+    # Basic email validation
+    if '@' not in email or '.' not in email:
+        return None, 'Invalid email format'
+
+    tz_name = data.get('timezone') or current_app.config['DEFAULT_TIMEZONE']
+    try:
+        if not isinstance(tz_name, str):
+            raise ValueError(tz_name)
+        ZoneInfo(tz_name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return None, 'Invalid timezone. Use an IANA name like Asia/Kolkata'
+
+    delivery_time = data.get('delivery_time') or current_app.config['DEFAULT_DELIVERY_TIME']
+    try:
+        if isinstance(delivery_time, str):
+            delivery_time = time.fromisoformat(delivery_time)
+        # A local time of day in the subscription's time zone, to the minute
+        if (not isinstance(delivery_time, time) or delivery_time.tzinfo is not None
+                or delivery_time.second or delivery_time.microsecond):
+            raise ValueError(delivery_time)
+    except ValueError:
+        return None, 'Invalid delivery_time format. Use HH:MM'
+
+    return {
+        'location_id': location_id,
+        'city_name': city_name,
+        'email': email,
+        'timezone': tz_name,
+        'delivery_time': slot_start(delivery_time, current_app.config['SCHEDULER_SLOT_MINUTES'])
+    }, None
+
+def read_import_rows(stream, fmt):
+    """
+    Read subscription rows from an uploaded CSV (with a header line) or JSON Lines file
+
+    Args:
+        stream: Binary file-like object, read line by line
+        fmt (str): 'csv' or 'jsonl'
+
+    Yields:
+        tuple: (line number, dict of fields, or None if the line isn't valid JSON)
+    """
+    lines = codecs.iterdecode(stream, 'utf-8-sig')
+    if fmt == 'csv':
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, row
+        return
+
+    for line_num, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_num, row if isinstance(row, dict) else None
+
+def import_subscriptions(user_id, rows):
+    """
+    Create subscriptions for a user from many rows in one transaction
+
+    Rows are validated one by one, but duplicates are found with sets: the
+    user's active (location_id, email) pairs are loaded once and rows
+    matching one of them, or an earlier row, are skipped. The rest are
+    bulk-inserted in SUBSCRIPTION_BATCH_SIZE chunks and committed together.
+
+    Args:
+        user_id (int): Owner of the subscriptions
+        rows (iterable): (line number, dict or None) pairs, as from ``read_import_rows``
+
+    Returns:
+        dict: Counts of imported, duplicate and invalid rows and the first errors
+
+    Raises:
+        ValueError: If there are more than SUBSCRIPTION_IMPORT_MAX_ROWS rows
+        SQLAlchemyError: If the insert fails; nothing is imported
+    """
+    max_rows = current_app.config['SUBSCRIPTION_IMPORT_MAX_ROWS']
+    batch_size = current_app.config['SUBSCRIPTION_BATCH_SIZE']
+
+    # Answered from the (user_id, is_active, location_id, email) index alone
+    seen = set(db.session.query(Subscription.location_id, Subscription.email).filter(
+        Subscription.user_id == user_id,
+        Subscription.is_active.is_(True)
+    ))
+
+    result = {'imported': 0, 'duplicates': 0, 'invalid': 0, 'errors': []}
+    batch = []
+    try:
+        for count, (line_num, row) in enumerate(rows, 1):
+            if count > max_rows:
+                raise ValueError(f"At most {max_rows} subscriptions per import")
+
+            values, error = validate_subscription(row) if row is not None else (None, 'Invalid JSON object')
+            if error:
+                result['invalid'] += 1
+                if len(result['errors']) < MAX_REPORTED_ERRORS:
+                    result['errors'].append({'line': line_num, 'error': error})
+                continue
+
+            key = (values['location_id'], values['email'])
+            if key in seen:
+                result['duplicates'] += 1
+                continue
+            seen.add(key)
+
+            values['user_id'] = user_id
+            batch.append(values)
+            if len(batch) >= batch_size:
+                db.session.bulk_insert_mappings(Subscription, batch)
+                result['imported'] += len(batch)
+                batch = []
+
+        if batch:
+            db.session.bulk_insert_mappings(Subscription, batch)
+            result['imported'] += len(batch)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return result
+
+def iter_subscription_export(user_id, fmt):
+    """
+    Stream a user's active subscriptions as CSV or JSON Lines
+
+    Rows are read in SUBSCRIPTION_BATCH_SIZE keyset pages of plain columns,
+    so memory stays at one page however many subscriptions there are.
+
+    Args:
+        user_id (int): Owner of the subscriptions
+        fmt (str): 'csv' or 'jsonl'
+
+    Yields:
+        str: Chunks of the file, one per page (the CSV header first)
+    """
+    batch_size = current_app.config['SUBSCRIPTION_BATCH_SIZE']
+    columns = [getattr(Subscription, field) for field in EXPORT_FIELDS]
+
+    if fmt == 'csv':
+        yield ','.join(EXPORT_FIELDS) + '\r\n'
+
+    last_id = 0
+    while True:
+        page = db.session.query(*columns).filter(
+            Subscription.user_id == user_id,
+            Subscription.is_active.is_(True),
+            Subscription.id > last_id
+        ).order_by(Subscription.id).limit(batch_size).all()
+        if not page:
+            return
+
+        records = [
+            dict(
+                row._asdict(),
+                delivery_time=row.delivery_time.strftime('%H:%M'),
+                created_at=row.created_at.isoformat() if row.created_at else None
+            )
+            for row in page
+        ]
+        if fmt == 'csv':
+            buffer = io.StringIO()
+            csv.DictWriter(buffer, EXPORT_FIELDS).writerows(records)
+            yield buffer.getvalue()
+        else:
+            yield ''.join(json.dumps(record) + '\n' for record in records)
+        last_id = page[-1].id
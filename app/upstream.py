@@ -0,0 +1,330 @@
+import asyncio
+import requests
+import threading
+import time
+from flask import current_app
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from app import metrics
+
+class UpstreamUnavailable(requests.RequestException):
+    """Raised without calling upstream because its circuit is open or it is rate limited"""
+
+class TokenBucket:
+    """Token-bucket rate limiter allowing ``rate`` calls per second with bursts of ``burst``"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self):
+        """Take a token if there is one; return 0, or the seconds until there will be"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self, max_wait):
+        """Take a token, waiting up to ``max_wait`` seconds; return False if none came"""
+        deadline = time.monotonic() + max_wait
+        while True:
+            wait = self._take()
+            if not wait:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    async def acquire_async(self, max_wait):
+        """Like ``acquire``, but waits without blocking the event loop"""
+        deadline = time.monotonic() + max_wait
+        while True:
+            wait = self._take()
+            if not wait:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+
+class CircuitBreaker:
+    """Stops calling an upstream that keeps failing
+
+    After ``failure_threshold`` consecutive failures the circuit opens and
+    calls are rejected for ``reset_timeout`` seconds. It then goes half-open
+    and lets a single probe through: success closes it, failure reopens it.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.in_flight = 0
+        self.rejected = 0
+        self.successes = 0
+        self.failures = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Register a call, or raise UpstreamUnavailable if the circuit doesn't allow it"""
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.OPEN or (self.state == self.HALF_OPEN and self._probing):
+                self.rejected += 1
+                raise UpstreamUnavailable('Upstream circuit is open')
+            if self.state == self.HALF_OPEN:
+                self._probing = True
+            self.in_flight += 1
+
+    def record_success(self):
+        with self._lock:
+            self.in_flight -= 1
+            self.successes += 1
+            self.consecutive_failures = 0
+            self.state = self.CLOSED
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.in_flight -= 1
+            self.failures += 1
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+    def record_abandoned(self):
+        """The caller gave up before upstream answered; says nothing about its health"""
+        with self._lock:
+            self.in_flight -= 1
+            self._probing = False
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'in_flight': self.in_flight,
+            'rejected': self.rejected,
+            'successes': self.successes,
+            'failures': self.failures,
+            'consecutive_failures': self.consecutive_failures
+        }
+
+class _Host:
+    """Concurrency limit, rate limiter and circuit breaker for one upstream host"""
+
+    def __init__(self, name, config):
+        self.name = name
+        self.semaphore = threading.BoundedSemaphore(config['PANCHANG_HOST_CONCURRENCY'])
+        # The async path's own limit; waiting on it costs no thread
+        self.async_semaphore = asyncio.BoundedSemaphore(config['PANCHANG_HOST_CONCURRENCY'])
+        self.rate_limiter = TokenBucket(config['UPSTREAM_RATE_LIMIT'], config['UPSTREAM_RATE_BURST'])
+        self.breaker = CircuitBreaker(
+            config['UPSTREAM_FAILURE_THRESHOLD'],
+            config['UPSTREAM_RESET_TIMEOUT']
+        )
+
+_session = None
+_lock = threading.Lock()
+_hosts = {}
+
+def get_http_session():
+    """Return the process-wide keep-alive HTTP session used for upstream calls"""
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                pool_size = current_app.config['PANCHANG_HOST_CONCURRENCY']
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+def _host(url):
+    name = urlsplit(url).netloc
+    host = _hosts.get(name)
+    if host is None:
+        with _lock:
+            host = _hosts.setdefault(name, _Host(name, current_app.config))
+    return host
+
+def _is_upstream_failure(error):
+    """Whether ``error`` says something about upstream health (rather than our request)"""
+    status = getattr(error.response, 'status_code', None)
+    return status is None or status >= 500 or status == 429
+
+def _call(host, url, params):
+    config = current_app.config
+    # The circuit is checked first, so calls it rejects fail at once and
+    # don't use up rate limit tokens
+    try:
+        host.breaker.before_call()
+    except UpstreamUnavailable:
+        metrics.upstream_requests_total.inc(host=host.name, outcome='circuit_open')
+        raise
+    try:
+        acquired = host.rate_limiter.acquire(config['UPSTREAM_RATE_LIMIT_MAX_WAIT'])
+    except BaseException:
+        host.breaker.record_abandoned()
+        raise
+    if not acquired:
+        host.breaker.record_abandoned()
+        metrics.upstream_requests_total.inc(host=host.name, outcome='rate_limited')
+        raise UpstreamUnavailable('Upstream rate limit exceeded')
+    try:
+        with host.semaphore, metrics.upstream_request_seconds.time(host=host.name):
+            response = get_http_session().get(
+                url,
+                params=params,
+                timeout=(config['PANCHANG_CONNECT_TIMEOUT'], config['PANCHANG_READ_TIMEOUT'])
+            )
+        response.raise_for_status()
+    except requests.RequestException as e:
+        metrics.upstream_requests_total.inc(host=host.name, outcome='error')
+        if _is_upstream_failure(e):
+            host.breaker.record_failure()
+        else:
+            host.breaker.record_success()
+        raise
+    except BaseException:
+        host.breaker.record_failure()
+        raise
+    metrics.upstream_requests_total.inc(host=host.name, outcome='ok')
+    host.breaker.record_success()
+    return response
+
+def fetch_upstream(url, params):
+    """
+    GET ``url`` over the shared session with rate limiting, timeouts,
+    circuit breaking and retry with backoff
+
+    Raises:
+        UpstreamUnavailable: If the call was refused locally without reaching upstream
+        requests.RequestException: If upstream failed on every attempt
+    """
+    config = current_app.config
+    retries = config['PANCHANG_FETCH_RETRIES']
+    host = _host(url)
+
+    for attempt in range(retries + 1):
+        try:
+            return _call(host, url, params)
+        except UpstreamUnavailable:
+            raise
+        except requests.RequestException as e:
+            # Client errors other than throttling won't succeed on a retry
+            if attempt == retries or not _is_upstream_failure(e):
+                raise
+            time.sleep(config['PANCHANG_RETRY_BACKOFF'] * 2 ** attempt)
+
+_async_client = None
+
+def get_async_http_client():
+    """Return the process-wide pooled async HTTP client used by the ASGI endpoints"""
+    global _async_client
+    if _async_client is None:
+        import httpx
+        config = current_app.config
+        _async_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(config['PANCHANG_READ_TIMEOUT'], connect=config['PANCHANG_CONNECT_TIMEOUT']),
+            limits=httpx.Limits(max_connections=config['PANCHANG_HOST_CONCURRENCY'] * 4)
+        )
+    return _async_client
+
+async def close_async_http_client():
+    """Close the async HTTP client's connections, e.g. at ASGI server shutdown"""
+    global _async_client
+    client, _async_client = _async_client, None
+    if client is not None:
+        await client.aclose()
+
+async def _call_async(host, url, params):
+    import httpx
+    
+    config = current_app.config
+    try:
+        host.breaker.before_call()
+    except UpstreamUnavailable:
+        metrics.upstream_requests_total.inc(host=host.name, outcome='circuit_open')
+        raise
+    try:
+        acquired = await host.rate_limiter.acquire_async(config['UPSTREAM_RATE_LIMIT_MAX_WAIT'])
+    except BaseException:
+        # Including cancellation while waiting for a token
+        host.breaker.record_abandoned()
+        raise
+    if not acquired:
+        host.breaker.record_abandoned()
+        metrics.upstream_requests_total.inc(host=host.name, outcome='rate_limited')
+        raise UpstreamUnavailable('Upstream rate limit exceeded')
+    try:
+        async with host.async_semaphore:
+            with metrics.upstream_request_seconds.time(host=host.name):
+                response = await get_async_http_client().get(url, params=params)
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        metrics.upstream_requests_total.inc(host=host.name, outcome='error')
+        # Raised as requests' exception so callers handle both paths alike
+        error = requests.RequestException(str(e), response=getattr(e, 'response', None))
+        if _is_upstream_failure(error):
+            host.breaker.record_failure()
+        else:
+            host.breaker.record_success()
+        raise error from e
+    except asyncio.CancelledError:
+        host.breaker.record_abandoned()
+        raise
+    except BaseException:
+        host.breaker.record_failure()
+        raise
+    metrics.upstream_requests_total.inc(host=host.name, outcome='ok')
+    host.breaker.record_success()
+    return response
+
+async def fetch_upstream_async(url, params):
+    """
+    Async version of ``fetch_upstream`` over a shared pooled httpx client
+
+    Shares the rate limiter and circuit breaker of the blocking path.
+
+    Raises:
+        UpstreamUnavailable: If the call was refused locally without reaching upstream
+        requests.RequestException: If upstream failed on every attempt
+    """
+    config = current_app.config
+    retries = config['PANCHANG_FETCH_RETRIES']
+    host = _host(url)
+
+    for attempt in range(retries + 1):
+        try:
+            return await _call_async(host, url, params)
+        except UpstreamUnavailable:
+            raise
+        except requests.RequestException as e:
+            # Client errors other than throttling won't succeed on a retry
+            if attempt == retries or not _is_upstream_failure(e):
+                raise
+            await asyncio.sleep(config['PANCHANG_RETRY_BACKOFF'] * 2 ** attempt)
+
+def upstream_status():
+    """Circuit breaker and rate limiter state for each upstream host"""
+    return {
+        name: dict(host.breaker.stats(), rate_limit_tokens=round(host.rate_limiter.tokens, 2))
+        for name, host in list(_hosts.items())
+    }
@@ -0,0 +1,77 @@
+"""Standalone worker that runs the scheduled jobs outside the web process
+
+Usage: python -m app.worker [--once [--print-metrics]] [--metrics-port PORT]
+
+Run the web tier with SCHEDULER_ENABLED=False so only workers send email.
+Several workers may run at once; a database lock makes sure exactly one of
+them runs each job per tick, while delivery of the email outbox is shared
+between them.
+"""
+import argparse
+import logging
+import signal
+import threading
+import time
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+from app import create_app
+from app.metrics import registry
+from app.scheduler import scheduler, init_scheduler, prefetch_panchang, send_daily_panchang_emails
+from config import Config
+
+class WorkerConfig(Config):
+    # The worker starts the scheduler itself
+    SCHEDULER_ENABLED = False
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def _handle_sigterm(signum, frame):
+    raise SystemExit(0)
+
+def serve_metrics(app, port):
+    """Serve the metrics registry on ``port`` from a background thread"""
+    def metrics_app(environ, start_response):
+        with app.app_context():
+            body = registry.render().encode()
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4')])
+        return [body]
+    
+    server = make_server('', port, metrics_app, handler_class=_QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the PyPanchang scheduled jobs')
+    parser.add_argument('--once', action='store_true', help='run the jobs once and exit')
+    parser.add_argument('--print-metrics', action='store_true', help='with --once, print metrics before exiting')
+    parser.add_argument('--metrics-port', type=int, help='serve metrics over HTTP on this port')
+    args = parser.parse_args(argv)
+    
+    app = create_app(WorkerConfig)
+    # Job run summaries are logged at INFO
+    app.logger.setLevel(logging.INFO)
+    
+    if args.metrics_port:
+        serve_metrics(app, args.metrics_port)
+    
+    if args.once:
+        scheduler.init_app(app)
+        prefetch_panchang()
+        send_daily_panchang_emails()
+        if args.print_metrics:
+            with app.app_context():
+                print(registry.render(), end='')
+        return
+    
+    signal.signal(signal.SIGTERM, _handle_sigterm)
+    init_scheduler(app)
+    app.logger.info("Worker started")
+    try:
+        while True:
+            time.sleep(60)
+    except (KeyboardInterrupt, SystemExit):
+        scheduler.shutdown()
+
+if __name__ == '__main__':
+    main()
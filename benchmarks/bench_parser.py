@@ -0,0 +1,104 @@
+"""Micro-benchmark of app.parser against the previous BeautifulSoup parser
+
+Usage: python benchmarks/bench_parser.py [--number N] [--fixture PATH]
+
+Needs beautifulsoup4, from benchmarks/requirements.txt.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.parser import parse_panchang
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', 'panfeed_sample.html')
+
+def legacy_parse_panchang_data(raw_data):
+    """The BeautifulSoup line scanner that app.parser replaced"""
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(raw_data, 'html.parser')
+    text_content = soup.get_text()
+    lines = [line.strip() for line in text_content.split('\n') if line.strip()]
+
+    data = {
+        'location': lines[0],
+        'date': lines[1],
+        'shaka': lines[2],
+        'vikrami_north': lines[3],
+        'vikrami_gujarat': lines[4],
+    }
+
+    for line in lines[5:]:
+        if '🔆' in line:
+            data['sunrise_sunset'] = line.replace('🔆', '').strip()
+        elif '🌙' in line:
+            data['moonrise_moonset'] = line.replace('🌙', '').strip()
+        elif 'Tamil:' in line:
+            data['tamil'] = line
+        elif 'Paksha' in line:
+            data['paksha'] = line
+        elif 'till' in line:
+            if 'Rahukalam:' in line:
+                data['rahukalam'] = line
+            elif 'Yamagandam:' in line:
+                data['yamagandam'] = line
+            elif 'Gulikai:' in line:
+                data['gulikai'] = line
+            elif 'Abhijit:' in line:
+                data['abhijit'] = line
+            elif 'Durmuhurtham:' in line:
+                data['durmuhurtham'] = line
+            elif 'Varjyam:' in line:
+                data['varjyam'] = line
+            elif 'Amritkalam:' in line:
+                data['amritkalam'] = line
+            else:
+                key = line.split(' till')[0].lower()
+                data[key] = line
+        elif 'Sun:' in line:
+            data['sun'] = line
+        elif 'Moon:' in line:
+            data['moon'] = line
+        elif 'Sayana Sun:' in line:
+            data['sayana_sun'] = line
+        elif 'Sun Star:' in line:
+            data['sun_star'] = line
+        elif 'DikShoolai:' in line:
+            data['dikshoolai'] = line
+        elif 'Kaal Vaasa:' in line:
+            data['kaal_vaasa'] = line
+        elif 'Rahu Vaasa:' in line:
+            data['rahu_vaasa'] = line
+        elif 'Agnivasa:' in line:
+            data['agnivasa'] = line
+        elif 'Moon abode:' in line:
+            data.setdefault('moon_abode', []).append(line)
+        elif 'Shraddha Tithi' in line:
+            data['shraddha_tithi'] = line
+
+    return data
+
+def bench(label, func, raw_data, number):
+    seconds = min(timeit.repeat(lambda: func(raw_data), number=number, repeat=5))
+    per_call = seconds / number * 1e6
+    print(f"{label:<14} {per_call:10.1f} us/parse  {number / seconds:12.0f} parses/s")
+    return per_call
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=2000)
+    parser.add_argument('--fixture', default=FIXTURE)
+    args = parser.parse_args()
+
+    with open(args.fixture, encoding='utf-8') as f:
+        raw_data = f.read()
+
+    legacy = bench('beautifulsoup', legacy_parse_panchang_data, raw_data, args.number)
+    current = bench('app.parser', parse_panchang, raw_data, args.number)
+    print(f"speedup        {legacy / current:10.1f}x")
+
+if __name__ == '__main__':
+    main()
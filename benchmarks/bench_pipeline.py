@@ -0,0 +1,222 @@
+"""Benchmark of the fetch -> parse -> render -> send pipeline
+
+Usage:
+    python benchmarks/bench_pipeline.py [--subscribers 100,1000] [--locations 10,100]
+                                        [--cities-per-recipient 1] [--repeat 3]
+                                        [--upstream-latency 0.05]
+
+Runs against a local stub of mypanchang.com serving the recorded fixture
+and a local SMTP sink, so results don't depend on the network. First the
+individual stages (parse_panchang_data, create_email_html,
+send_panchang_email) are timed, then send_daily_panchang_emails is run end
+to end for every combination of subscriber and distinct location counts.
+Subscriptions are spread over recipients with --cities-per-recipient
+subscriptions each; every recipient gets one email.
+Each end-to-end scenario runs in a fresh subprocess so its peak RSS is its
+own. Reported latencies for the end-to-end runs are the time from the start
+of the run until each email reached the sink.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import time as time_of_day
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from servers import FIXTURES, SMTPSink, StubUpstream
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of ``values``"""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def make_app(workdir, upstream, sink):
+    """Create the app wired to the stub upstream and SMTP sink"""
+    from app import create_app
+    from config import Config
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+        PANCHANG_API_BASE_URL = f"{upstream.url}/newsite/panfeed.php"
+        PLACE_QUERY_URL = f"{upstream.url}/newsite/placequery.php"
+        PANCHANG_CACHE_PATH = os.path.join(workdir, 'panchang_cache.db')
+        MAIL_SERVER = '127.0.0.1'
+        MAIL_PORT = sink.port
+        MAIL_USE_TLS = False
+        MAIL_USE_SSL = False
+        MAIL_USERNAME = None
+        MAIL_PASSWORD = None
+        MAIL_DEFAULT_SENDER = 'bench@localhost'
+        SCHEDULER_ENABLED = False
+        # Don't let the production rate limit dominate the numbers
+        UPSTREAM_RATE_LIMIT = 1e9
+        UPSTREAM_RATE_BURST = 10 ** 9
+
+    return create_app(BenchConfig)
+
+def seed(app, subscribers, locations, cities_per_recipient):
+    from app.models import db, Subscription, User
+
+    with app.app_context():
+        db.create_all()
+        user = User(email='bench@localhost', name='bench')
+        db.session.add(user)
+        db.session.commit()
+        db.session.bulk_insert_mappings(Subscription, [
+            {
+                'user_id': user.id,
+                'location_id': str(1000 + i % locations),
+                'city_name': f"City {i % locations}",
+                'email': f"subscriber{i // cities_per_recipient}@localhost",
+                'is_active': True,
+                'timezone': 'UTC',
+                'delivery_time': time_of_day(0, 0),
+            }
+            for i in range(subscribers)
+        ])
+        db.session.commit()
+
+def run_scenario(subscribers, locations, cities_per_recipient, upstream_latency):
+    """Run the email job once in this process and return its measurements"""
+    from app.scheduler import scheduler, send_daily_panchang_emails
+
+    upstream = StubUpstream(latency=upstream_latency).start()
+    sink = SMTPSink().start()
+    with tempfile.TemporaryDirectory() as workdir:
+        app = make_app(workdir, upstream, sink)
+        seed(app, subscribers, locations, cities_per_recipient)
+        scheduler.init_app(app)
+
+        start = time.perf_counter()
+        send_daily_panchang_emails()
+        duration = time.perf_counter() - start
+
+    latencies = [received - start for received in sink.received]
+    upstream.stop()
+    sink.stop()
+    return {
+        'subscribers': subscribers,
+        'locations': locations,
+        'cities_per_recipient': cities_per_recipient,
+        'emails': len(latencies),
+        'upstream_requests': upstream.requests,
+        'duration': duration,
+        'throughput': len(latencies) / duration if duration else 0.0,
+        'p50': percentile(latencies, 0.50),
+        'p99': percentile(latencies, 0.99),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def bench_stages(number):
+    """Time the individual pipeline stages; return rows of (stage, latencies)"""
+    from app.email_service import (
+        create_email_html, create_panchang_card, parse_panchang_data, send_panchang_email
+    )
+
+    with open(os.path.join(FIXTURES, 'panfeed_sample.html'), encoding='utf-8') as f:
+        raw_data = f.read()
+
+    upstream = StubUpstream().start()
+    sink = SMTPSink().start()
+    rows = []
+    with tempfile.TemporaryDirectory() as workdir:
+        app = make_app(workdir, upstream, sink)
+        with app.app_context():
+            parsed = parse_panchang_data(raw_data)
+            panchang_data = {'raw_data': raw_data, 'location_id': '1000', 'date': '2026-01-01'}
+            stages = (
+                ('parse_panchang_data', lambda: parse_panchang_data(raw_data)),
+                ('create_email_html', lambda: create_email_html(
+                    [('City', create_panchang_card('City', '2026-01-01', parsed))]
+                )),
+                ('send_panchang_email', lambda: send_panchang_email('a@localhost', 'City', panchang_data)),
+            )
+            for name, func in stages:
+                latencies = []
+                for _ in range(number):
+                    start = time.perf_counter()
+                    func()
+                    latencies.append(time.perf_counter() - start)
+                rows.append((name, latencies))
+    upstream.stop()
+    sink.stop()
+    return rows
+
+def parse_counts(value):
+    return [int(part) for part in value.split(',') if part]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--subscribers', type=parse_counts, default=[100, 1000])
+    parser.add_argument('--locations', type=parse_counts, default=[10, 100])
+    parser.add_argument('--cities-per-recipient', type=int, default=1,
+                        help='subscriptions per recipient address')
+    parser.add_argument('--repeat', type=int, default=3, help='end-to-end runs per scenario')
+    parser.add_argument('--stage-number', type=int, default=200, help='calls per stage benchmark')
+    parser.add_argument('--upstream-latency', type=float, default=0.0,
+                        help='seconds the stub upstream waits before answering')
+    parser.add_argument('--json', action='store_true', help='print one JSON object per result')
+    parser.add_argument('--scenario', nargs=3, type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario:
+        print(json.dumps(run_scenario(*args.scenario, args.upstream_latency)))
+        return
+
+    # With --json every line is a result, so the tables' headers are left out
+    if not args.json:
+        print(f"{'stage':<22} {'calls/s':>10} {'p50 ms':>9} {'p99 ms':>9}")
+    for name, latencies in bench_stages(args.stage_number):
+        if args.json:
+            print(json.dumps({'stage': name, 'p50': percentile(latencies, 0.5), 'p99': percentile(latencies, 0.99)}))
+            continue
+        print(
+            f"{name:<22} {len(latencies) / sum(latencies):10.0f} "
+            f"{percentile(latencies, 0.5) * 1e3:9.3f} {percentile(latencies, 0.99) * 1e3:9.3f}"
+        )
+
+    if not args.json:
+        print()
+        print(
+            f"{'subscribers':>11} {'locations':>9} {'emails':>7} {'upstream':>8} {'seconds':>8} "
+            f"{'emails/s':>9} {'p50 s':>7} {'p99 s':>7} {'peak MB':>8}"
+        )
+    for subscribers in args.subscribers:
+        for locations in args.locations:
+            for _ in range(args.repeat):
+                output = subprocess.run(
+                    [
+                        sys.executable, os.path.abspath(__file__),
+                        '--scenario', str(subscribers), str(locations), str(args.cities_per_recipient),
+                        '--upstream-latency', str(args.upstream_latency),
+                    ],
+                    check=True, capture_output=True, text=True
+                ).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                if args.json:
+                    print(json.dumps(result))
+                    continue
+                print(
+                    f"{result['subscribers']:>11} {result['locations']:>9} {result['emails']:>7} "
+                    f"{result['upstream_requests']:>8} {result['duration']:8.2f} "
+                    f"{result['throughput']:9.1f} {result['p50']:7.2f} {result['p99']:7.2f} "
+                    f"{result['peak_rss_mb']:8.1f}"
+                )
+
+if __name__ == '__main__':
+    main()
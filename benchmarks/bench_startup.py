@@ -0,0 +1,80 @@
+"""Benchmark of cold-start time: importing the app and creating it
+
+Usage: python benchmarks/bench_startup.py [--repeat 10] [--top 15]
+
+Every sample runs in a fresh interpreter, as a gunicorn worker, CLI
+invocation or the standalone worker would. Reports the median and max of
+the time to import the app package, to run create_app() and to start the
+standalone worker's app, then lists the slowest imports (cumulative, from
+python -X importtime) of a web process start.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SAMPLE = """
+import json, time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+create_app()
+created = time.perf_counter()
+from app.worker import WorkerConfig
+create_app(WorkerConfig)
+worker = time.perf_counter()
+print(json.dumps({
+    'import app': imported - start,
+    'create_app()': created - imported,
+    'worker app': worker - created,
+    'total': worker - start,
+}))
+"""
+
+def sample():
+    output = subprocess.run(
+        [sys.executable, '-c', SAMPLE], cwd=ROOT, check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def slowest_imports(top):
+    """Return the ``top`` (cumulative microseconds, module) pairs of a web process start"""
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'from app import create_app; create_app()'],
+        cwd=ROOT, check=True, capture_output=True, text=True
+    ).stderr
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        # Modules imported at the top level or directly by them; deeper
+        # imports are included in their importer's cumulative time
+        depth = (len(module) - len(module.lstrip()) - 1) // 2
+        if depth <= 1:
+            imports.append((int(cumulative), module.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=10, help='fresh interpreters to sample')
+    parser.add_argument('--top', type=int, default=15, help='slowest imports to list')
+    args = parser.parse_args()
+
+    samples = [sample() for _ in range(args.repeat)]
+    print(f"{'phase':<14} {'median ms':>10} {'max ms':>8}")
+    for phase in samples[0]:
+        values = [s[phase] * 1e3 for s in samples]
+        print(f"{phase:<14} {statistics.median(values):10.1f} {max(values):8.1f}")
+
+    print()
+    print(f"{'cumulative ms':>13}  module")
+    for cumulative, module in slowest_imports(args.top):
+        print(f"{cumulative / 1e3:13.1f}  {module}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Local stand-ins for mypanchang.com and the SMTP relay used by the benchmarks"""
+import json
+import os
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+class StubUpstream:
+    """Serves the recorded panfeed fixture and a canned place query answer
+
+    ``latency`` seconds are slept before each response to mimic the real
+    upstream's round trip.
+    """
+
+    def __init__(self, latency=0.0, fixture='panfeed_sample.html'):
+        with open(os.path.join(FIXTURES, fixture), 'rb') as f:
+            feed = f.read()
+        places = json.dumps([{'id': '1275339', 'name': 'Mumbai, India'}]).encode()
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests += 1
+                if latency:
+                    time.sleep(latency)
+                if 'placequery' in self.path:
+                    body, content_type = places, 'application/json'
+                else:
+                    body, content_type = feed, 'text/html; charset=utf-8'
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class SMTPSink:
+    """Minimal SMTP server that accepts and discards mail, recording arrival times"""
+
+    def __init__(self):
+        self.received = []
+        self._lock = threading.Lock()
+        sink = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, line):
+                self.wfile.write(line.encode() + b'\r\n')
+
+            def handle(self):
+                self.reply('220 sink ESMTP')
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    command = line[:4].upper()
+                    if command == b'EHLO':
+                        self.reply('250-sink')
+                        self.reply('250 8BITMIME')
+                    elif command == b'DATA':
+                        self.reply('354 End data with <CR><LF>.<CR><LF>')
+                        while self.rfile.readline() not in (b'.\r\n', b'.\n', b''):
+                            pass
+                        with sink._lock:
+                            sink.received.append(time.perf_counter())
+                        self.reply('250 OK')
+                    elif command == b'QUIT':
+                        self.reply('221 Bye')
+                        return
+                    elif command in (b'HELO', b'MAIL', b'RCPT', b'RSET', b'NOOP'):
+                        self.reply('250 OK')
+                    else:
+                        self.reply('502 Command not implemented')
+
+        class Server(socketserver.ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.port = self.server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
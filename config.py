@@ -1,4 +1,5 @@
 import os
+from datetime import time
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -11,6 +12,12 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL', 'sqlite:///panchang.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     
+    # Verified API tokens are cached in-process for this many seconds. A
+    # rotated token stops working at once in the process that rotated it and
+    # within the TTL everywhere else.
+    API_TOKEN_CACHE_TTL = int(os.getenv('API_TOKEN_CACHE_TTL', 300))
+    API_TOKEN_CACHE_MAX_ENTRIES = int(os.getenv('API_TOKEN_CACHE_MAX_ENTRIES', 10000))
+    
     # GitHub OAuth
     GITHUB_CLIENT_ID = os.getenv('GITHUB_CLIENT_ID')
     GITHUB_CLIENT_SECRET = os.getenv('GITHUB_CLIENT_SECRET')
@@ -22,6 +29,52 @@ class Config:
     # Panchang API
     PANCHANG_API_BASE_URL = "https://mypanchang.com/newsite/panfeed.php"
     
+    PLACE_QUERY_URL = "https://mypanchang.com/newsite/placequery.php"
+    # Most (location, date) pairs one /api/panchang/batch request may ask for
+    PANCHANG_BATCH_MAX_ITEMS = int(os.getenv('PANCHANG_BATCH_MAX_ITEMS', 1000))
+    # The same without an X-API-Token; batches share the upstream rate limit
+    # with delivery and /api/panchang, so anonymous ones stay small
+    PANCHANG_BATCH_ANONYMOUS_MAX_ITEMS = int(os.getenv('PANCHANG_BATCH_ANONYMOUS_MAX_ITEMS', 30))
+    # Cache-Control max-age of /api/panchang responses for other days (which
+    # never change) and for today (which the dateless URL moves off of)
+    PANCHANG_HTTP_MAX_AGE = int(os.getenv('PANCHANG_HTTP_MAX_AGE', 365 * 24 * 3600))
+    PANCHANG_HTTP_TODAY_MAX_AGE = int(os.getenv('PANCHANG_HTTP_TODAY_MAX_AGE', 300))
+    # Smaller responses are not worth compressing
+    HTTP_COMPRESSION_MIN_SIZE = int(os.getenv('HTTP_COMPRESSION_MIN_SIZE', 512))
+    
+    # Location search: most places returned from the local index, and the
+    # most upstream returns for one query. An upstream answer with at least
+    # UPSTREAM_PLACE_QUERY_LIMIT places is taken to be cut off, so the index
+    # doesn't answer longer queries from it.
+    LOCATION_QUERY_TTL = int(os.getenv('LOCATION_QUERY_TTL', 30 * 24 * 3600))
+    LOCATION_SEARCH_LIMIT = int(os.getenv('LOCATION_SEARCH_LIMIT', 20))
+    UPSTREAM_PLACE_QUERY_LIMIT = int(os.getenv('UPSTREAM_PLACE_QUERY_LIMIT', 10))
+    
+    # Upstream fetching
+    PANCHANG_FETCH_WORKERS = int(os.getenv('PANCHANG_FETCH_WORKERS', 16))
+    PANCHANG_HOST_CONCURRENCY = int(os.getenv('PANCHANG_HOST_CONCURRENCY', 8))
+    PANCHANG_CONNECT_TIMEOUT = float(os.getenv('PANCHANG_CONNECT_TIMEOUT', 5))
+    PANCHANG_READ_TIMEOUT = float(os.getenv('PANCHANG_READ_TIMEOUT', 15))
+    PANCHANG_FETCH_RETRIES = int(os.getenv('PANCHANG_FETCH_RETRIES', 3))
+    PANCHANG_RETRY_BACKOFF = float(os.getenv('PANCHANG_RETRY_BACKOFF', 0.5))
+    
+    # Upstream protection: token-bucket rate limit (calls/s and burst) and a
+    # circuit breaker that opens after consecutive failures and probes again
+    # after the reset timeout
+    UPSTREAM_RATE_LIMIT = float(os.getenv('UPSTREAM_RATE_LIMIT', 10))
+    UPSTREAM_RATE_BURST = int(os.getenv('UPSTREAM_RATE_BURST', 20))
+    UPSTREAM_RATE_LIMIT_MAX_WAIT = float(os.getenv('UPSTREAM_RATE_LIMIT_MAX_WAIT', 2))
+    UPSTREAM_FAILURE_THRESHOLD = int(os.getenv('UPSTREAM_FAILURE_THRESHOLD', 5))
+    UPSTREAM_RESET_TIMEOUT = float(os.getenv('UPSTREAM_RESET_TIMEOUT', 30))
+    
+    # Panchang Cache (a day's panchang for a location never changes)
+    PANCHANG_CACHE_TTL = int(os.getenv('PANCHANG_CACHE_TTL', 30 * 24 * 3600))
+    PANCHANG_CACHE_MEMORY_MAX_ENTRIES = int(os.getenv('PANCHANG_CACHE_MEMORY_MAX_ENTRIES', 2048))
+    PANCHANG_CACHE_DURABLE = os.getenv('PANCHANG_CACHE_DURABLE', 'True').lower() == 'true'
+    PANCHANG_CACHE_DISK_MAX_ENTRIES = int(os.getenv('PANCHANG_CACHE_DISK_MAX_ENTRIES', 100000))
+    PANCHANG_CACHE_PATH = os.getenv('PANCHANG_CACHE_PATH')  # Defaults to the instance folder
+    RENDERED_EMAIL_CACHE_MAX_ENTRIES = int(os.getenv('RENDERED_EMAIL_CACHE_MAX_ENTRIES', 1024))
+    
     # Email Settings
     MAIL_SERVER = os.getenv('MAIL_SERVER', 'smtp.mailgun.org')
     MAIL_PORT = int(os.getenv('MAIL_PORT', 587))
@@ -29,6 +82,52 @@ class Config:
     MAIL_USERNAME = os.getenv('MAIL_USERNAME')
     MAIL_PASSWORD = os.getenv('MAIL_PASSWORD')
     MAIL_DEFAULT_SENDER = os.getenv('MAIL_DEFAULT_SENDER')
+    MAIL_MESSAGES_PER_CONNECTION = int(os.getenv('MAIL_MESSAGES_PER_CONNECTION', 100))
+    
+    # Delivery pipeline: threads per stage (fetch, render, send; each send
+    # thread holds one SMTP connection) and the size of the queues between
+    # stages, which bounds how far a fast stage can run ahead
+    PIPELINE_FETCH_WORKERS = int(os.getenv('PIPELINE_FETCH_WORKERS', 8))
+    PIPELINE_RENDER_WORKERS = int(os.getenv('PIPELINE_RENDER_WORKERS', 2))
+    PIPELINE_SEND_WORKERS = int(os.getenv('PIPELINE_SEND_WORKERS', 4))
+    PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', 32))
+    
+    # Email outbox: a message that fails is retried after OUTBOX_RETRY_BACKOFF
+    # seconds, doubling each attempt, until OUTBOX_MAX_ATTEMPTS make it dead.
+    # A worker's claim on messages expires after OUTBOX_CLAIM_TTL seconds.
+    # A message waiting for its panchang is dead OUTBOX_DEFER_MAX_DAYS after
+    # its local date.
+    OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 5))
+    OUTBOX_RETRY_BACKOFF = float(os.getenv('OUTBOX_RETRY_BACKOFF', 60))
+    OUTBOX_CLAIM_TTL = int(os.getenv('OUTBOX_CLAIM_TTL', 300))
+    OUTBOX_DEFER_MAX_DAYS = int(os.getenv('OUTBOX_DEFER_MAX_DAYS', 1))
+    OUTBOX_POLL_INTERVAL_SECONDS = int(os.getenv('OUTBOX_POLL_INTERVAL_SECONDS', 60))
+    OUTBOX_RETENTION_DAYS = int(os.getenv('OUTBOX_RETENTION_DAYS', 30))
     
     # Scheduler Settings
-    SCHEDULER_API_ENABLED = True 
\ No newline at end of file
+    SCHEDULER_API_ENABLED = True
+    # Run the scheduled jobs inside the web process. Off by default: jobs
+    # run in the standalone worker (python -m app.worker).
+    SCHEDULER_ENABLED = os.getenv('SCHEDULER_ENABLED', 'False').lower() == 'true'
+    # Seconds a process may hold a job lock before another may take it over
+    SCHEDULER_LOCK_TTL = int(os.getenv('SCHEDULER_LOCK_TTL', 600))
+    # Subscriptions processed (and committed) per chunk by the email job
+    SCHEDULER_BATCH_SIZE = int(os.getenv('SCHEDULER_BATCH_SIZE', 500))
+    # Delivery times are bucketed into slots of this many minutes (must
+    # divide 60); the email job runs once at the start of every slot
+    SCHEDULER_SLOT_MINUTES = int(os.getenv('SCHEDULER_SLOT_MINUTES', 15))
+    
+    # Tomorrow's panchang for every subscribed location is fetched ahead of
+    # delivery by a job running this often. With FETCH_ON_MISS off, the
+    # delivery job never goes upstream and waits for the prefetch instead.
+    PANCHANG_PREFETCH_INTERVAL_MINUTES = int(os.getenv('PANCHANG_PREFETCH_INTERVAL_MINUTES', 60))
+    PANCHANG_DELIVERY_FETCH_ON_MISS = os.getenv('PANCHANG_DELIVERY_FETCH_ON_MISS', 'True').lower() == 'true'
+    
+    # Subscription import and export: rows inserted or read per statement,
+    # and the most rows one import may contain
+    SUBSCRIPTION_BATCH_SIZE = int(os.getenv('SUBSCRIPTION_BATCH_SIZE', 1000))
+    SUBSCRIPTION_IMPORT_MAX_ROWS = int(os.getenv('SUBSCRIPTION_IMPORT_MAX_ROWS', 100000))
+    
+    # Subscription defaults
+    DEFAULT_TIMEZONE = os.getenv('DEFAULT_TIMEZONE', 'Asia/Kolkata')
+    DEFAULT_DELIVERY_TIME = time.fromisoformat(os.getenv('DEFAULT_DELIVERY_TIME', '06:00')) 
\ No newline at end of file